@@ -0,0 +1,161 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import numpy as np
+import pandas as pd
+
+from proc import COL_NAMES
+
+# -----------------------------------------------------#
+#                 Neighbourhood Statistics             #
+# -----------------------------------------------------#
+def confidence(probs, criterion="maxprob"):
+    # Maximum softmax or difference between the two highest probabilities
+    probs = np.sort(probs, axis=-1)
+    if criterion == "margin" : return probs[..., -1] - probs[..., -2]
+    return probs[..., -1]
+
+def lattice(tiles, stride):
+    # Sparse lattice of every stride-th tile in both directions
+    return ((tiles["x"] % stride == 0) & (tiles["y"] % stride == 0)).to_numpy()
+
+def neighbourhood(probs, scored, xs, ys, radius, threshold, criterion="maxprob"):
+    """ Summarize the scored neighbours of tiles within a square window.
+
+    Args:
+        probs (numpy.ndarray):      Soft labels of the grid with shape (nx, ny, nclasses).
+        scored (numpy.ndarray):     Boolean mask of scored tiles with shape (nx, ny).
+        xs, ys (numpy.ndarray):     Grid positions of the tiles.
+        radius (int):               Neighbours within this Chebyshev distance are considered.
+        threshold (float):          Confidence below which a neighbour is uncertain.
+
+    Returns:
+        count (numpy.ndarray):      Number of scored neighbours of each tile.
+        mean (numpy.ndarray):       Mean soft labels of the scored neighbours.
+        uncertain (numpy.ndarray):  Whether the neighbours disagree or any of them is uncertain.
+    """
+    nx, ny, nclasses = probs.shape
+    conf = confidence(probs, criterion)
+    labels = np.argmax(probs, axis=-1)
+    count = np.zeros(len(xs), dtype=np.int32)
+    total = np.zeros((len(xs), nclasses), dtype=np.float64)
+    classes = np.zeros((len(xs), nclasses), dtype=bool)
+    low = np.zeros(len(xs), dtype=bool)
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            if dx == 0 and dy == 0 : continue
+            gx, gy = xs + dx, ys + dy
+            i = np.where((gx >= 0) & (gx < nx) & (gy >= 0) & (gy < ny))[0]
+            i = i[scored[gx[i], gy[i]]]
+            gx, gy = gx[i], gy[i]
+            count[i] += 1
+            total[i] += probs[gx, gy]
+            classes[i, labels[gx, gy]] = True
+            low[i] |= conf[gx, gy] < threshold
+    mean = total / np.maximum(count, 1)[:, np.newaxis]
+    uncertain = (classes.sum(axis=1) > 1) | low
+    return count, mean, uncertain
+
+# -----------------------------------------------------#
+#                  Adaptive Inference                  #
+# -----------------------------------------------------#
+def run_adaptive(x, tiles, predict, known=None, stride=2, threshold=0.9,
+                 criterion="maxprob", max_rounds=10):
+    """ Score a sparse lattice of tiles and refine where the neighbourhood is ambiguous.
+
+    First, every stride-th tile in both directions is scored (density 1/stride²).
+    Afterwards, unscored tiles are scored if their scored neighbours (within a
+    distance of stride-1 tiles) disagree or have a confidence below the threshold.
+    This is repeated with the newly scored tiles until no further tile qualifies
+    (or max_rounds is reached). The remaining tiles are filled with the mean soft
+    labels of their neighbours. The column "model" records "interpolated" for them.
+
+    Args:
+        x (list):                       Sample names of the tiles to predict.
+        tiles (pandas.DataFrame):       Sample names and grid positions (x/y) of all tiles
+                                        of x and known.
+        predict (function):             Predicts a list of sample names as run_aucmedi.
+        known (pandas.DataFrame):       Available predictions used as neighbours
+                                        (e.g. background tiles or resumed progress).
+        stride (int):                   Stride of the initial lattice.
+        threshold (float):              Confidence below which a neighbour triggers scoring.
+        criterion (str):                Confidence measure: "maxprob" or "margin".
+        max_rounds (int):               Maximum number of refinement rounds.
+
+    Returns:
+        df (pandas.DataFrame):          Predictions of x as returned by run_aucmedi.
+    """
+    radius = max(stride - 1, 1)
+    positions = tiles.set_index("sample")[["x", "y"]]
+    nx, ny = positions["x"].max() + 1, positions["y"].max() + 1
+    probs = np.zeros((nx, ny, len(COL_NAMES)), dtype=np.float32)
+    scored = np.zeros((nx, ny), dtype=bool)
+    def add(df):
+        xy = positions.loc[df["sample"]].to_numpy()
+        probs[xy[:, 0], xy[:, 1]] = df[COL_NAMES].to_numpy()
+        scored[xy[:, 0], xy[:, 1]] = True
+    if known is not None and len(known) > 0 : add(known)
+
+    todo = positions.loc[list(x)].reset_index()
+    select = todo[lattice(todo, stride)]
+    df_list = []
+    rounds = 0
+    while True:
+        if len(select) > 0:
+            df = predict(list(select["sample"]))
+            add(df)
+            df_list.append(df)
+            rounds += 1
+            todo = todo[~scored[todo["x"].to_numpy(), todo["y"].to_numpy()]]
+        # Tiles without scored neighbours or with an ambiguous neighbourhood are scored
+        count, mean, uncertain = neighbourhood(probs, scored, todo["x"].to_numpy(),
+                                               todo["y"].to_numpy(), radius,
+                                               threshold, criterion)
+        refine = count == 0
+        if rounds < max_rounds : refine |= uncertain
+        select = todo[refine]
+        if len(select) == 0 : break
+    # Fill remaining tiles from their neighbours
+    df_fill = pd.DataFrame(mean.astype(np.float32), columns=COL_NAMES)
+    df_fill["sample"] = todo["sample"].to_numpy()
+    df_fill["class"] = df_fill[COL_NAMES].idxmax(axis=1)
+    df_fill["model"] = "interpolated"
+    df_list.append(df_fill)
+    df = pd.concat(df_list, ignore_index=True)
+    df[COL_NAMES] = df[COL_NAMES].astype(np.float32)
+    return df
+
+def adaptive_report(df_adaptive, df_dense, time_adaptive, time_dense):
+    # Compare an adaptive run with a dense run of the same model on the same tiles
+    df = df_adaptive.merge(df_dense, on="sample", suffixes=("_adaptive", "_dense"))
+    agree = df["class_adaptive"] == df["class_dense"]
+    interpolated = df["model_adaptive"] == "interpolated"
+    report = {
+        "tiles": len(df),
+        "scored": int((~interpolated).sum()),
+        "scored_fraction": float((~interpolated).mean()),
+        "speedup": time_dense / max(time_adaptive, 1e-9),
+        "agreement": float(agree.mean()),
+        "agreement_interpolated": float(agree[interpolated].mean()) \
+                                  if interpolated.any() else None,
+        "agreement_per_class": {c: float(agree[df["class_dense"] == c].mean()) \
+                                for c in COL_NAMES if (df["class_dense"] == c).any()},
+    }
+    return report
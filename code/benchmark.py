@@ -0,0 +1,386 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import math
+import time
+import json
+import sys
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import pyvips
+from PIL import Image
+
+from proc import gen_tiles, tile_loader, class_reassemble, render_class_map
+from proc import COL_NAMES
+from adaptive import run_adaptive, adaptive_report
+from slide_reader import open_slide
+
+# -----------------------------------------------------#
+#                     CLI Argparser                    #
+# -----------------------------------------------------#
+parser = argparse.ArgumentParser(description="DeepGleason: Benchmark")
+parser.add_argument(
+    "--sizes",
+    help="Comma separated numbers of tiles of the synthetic slides",
+    dest="sizes",
+    default="1000,10000,100000",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--model",
+    help="Model used for the inference stage",
+    dest="model",
+    default="models/model.DenseNet121.hdf5",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--snapshot",
+    help="Model snapshot of --model (exported via code/export.py --mode snapshot) " + \
+         "for the startup benchmark",
+    dest="snapshot",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--startup",
+    help="Additionally measure the startup time of the CLI (--help) and of " + \
+         "loading the model (and the snapshot) in fresh processes",
+    dest="startup",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "--random_weights",
+    help="Skip loading the model weights (architecture with random weights)",
+    dest="random_weights",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "--skip_inference",
+    help="Skip the inference stage (e.g. on machines without TensorFlow, the " + \
+         "stain normalization stage is skipped if AUCMEDI is not installed)",
+    dest="skip_inference",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "--max_tiles",
+    help="Maximum number of tiles for the per-tile stages " + \
+         "(tile reading, stain normalization, inference)",
+    dest="max_tiles",
+    default=512,
+    required=False,
+    type=int,
+)
+parser.add_argument(
+    "--batch_size",
+    help="Number of tiles per batch during inference",
+    dest="batch_size",
+    default=32,
+    required=False,
+    type=int,
+)
+parser.add_argument(
+    "--adaptive_stride",
+    help="Lattice stride of the adaptive sparse inference stage",
+    dest="adaptive_stride",
+    default=2,
+    required=False,
+    type=int,
+)
+parser.add_argument(
+    "--replica_sweep",
+    help="Comma separated numbers of inference replicas for which the throughput " + \
+         "is measured (e.g. 1,2,4,8,16), each pinned to a disjoint core set",
+    dest="replica_sweep",
+    default=None,
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--sweep_inter_op",
+    help="Comma separated numbers of inter-op threads per replica for the replica sweep",
+    dest="sweep_inter_op",
+    default="1,2",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--cache",
+    help="Directory for the synthetic slides and outputs. Default: temporary directory",
+    dest="cache",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    help="Path of the JSON file with the benchmark results",
+    dest="output",
+    default="benchmark.json",
+    required=False,
+    type=str,
+)
+args = parser.parse_args()
+
+PATCH_SIZE = (1024, 1024)
+
+# -----------------------------------------------------#
+#                   Synthetic Slides                   #
+# -----------------------------------------------------#
+def synthetic_slide(path, n_tiles, seed=0):
+    """ Generate a synthetic pyramidal BigTIFF with one page per RGB channel.
+
+    Tissue is simulated by thresholded Perlin noise on a white background,
+    thus roughly half of the tiles contain tissue.
+    """
+    nx = math.ceil(math.sqrt(n_tiles))
+    ny = math.ceil(n_tiles / nx)
+    # Slide dimensions are not a multiple of the tile size (as real slides)
+    width = nx * PATCH_SIZE[0] + PATCH_SIZE[0] // 3
+    height = ny * PATCH_SIZE[1] + PATCH_SIZE[1] // 3
+    tissue = pyvips.Image.perlin(width, height, cell_size=4 * PATCH_SIZE[0],
+                                 seed=seed) > 0
+    texture = pyvips.Image.perlin(width, height, cell_size=16, seed=seed + 1)
+    channels = []
+    for color in [(180, 40), (90, 50), (170, 30)]:
+        stain = (texture * color[1] + color[0]).cast("uchar")
+        channels.append(tissue.ifthenelse(stain, 235))
+    img = pyvips.Image.arrayjoin(channels, across=1)
+    img = img.copy()
+    img.set_type(pyvips.GValue.gint_type, "page-height", height)
+    img.tiffsave(path, compression="jpeg", tile=True,
+                 tile_width=256, tile_height=256,
+                 pyramid=True, subifd=True, bigtiff=True,
+                 xres=4000, yres=4000)
+    return path
+
+# -----------------------------------------------------#
+#                  Benchmark Stages                    #
+# -----------------------------------------------------#
+def timed(func, *func_args, **func_kwargs):
+    time_start = time.time()
+    res = func(*func_args, **func_kwargs)
+    return res, time.time() - time_start
+
+def benchmark_slide(slide, model=None):
+    slide_name = os.path.basename(slide)
+    slide_name = slide_name[: slide_name.find(".")]
+    results = {}
+    # Tiling: slide opening, tile grid and tissue mask
+    (img, tiles, max_X, max_Y, xres, yres, _), t = timed(
+        gen_tiles, None, slide, slide_name, PATCH_SIZE, 0.05)
+    tissue = tiles[tiles["tissue"]]
+    results["tiles"] = len(tiles)
+    results["tissue_tiles"] = len(tissue)
+    results["tiling"] = {"seconds": t}
+    # Per-tile stages on a sample of the tissue tiles (none without tissue)
+    sample = tissue.iloc[:args.max_tiles]
+    if len(sample) > 0 : results.update(benchmark_tiles(slide, img, tiles, sample, model))
+    # Random predictions for the complete grid
+    probs = np.random.dirichlet(np.ones(len(COL_NAMES)), size=len(tiles))
+    df_res = pd.DataFrame(probs, columns=COL_NAMES)
+    df_res["class"] = df_res[COL_NAMES].idxmax(axis=1)
+    df_res = pd.concat([tiles[["sample", "x", "y"]], df_res], axis=1)
+    # Class reassembly
+    small_version, t = timed(class_reassemble, max_X, max_Y, slide_name, df_res,
+                             PATCH_SIZE)
+    results["class_reassemble"] = {"seconds": t}
+    # Writing of the pyramidal class map
+    path_output = os.path.join(os.path.dirname(slide), slide_name + "_gleason.tiff")
+    res = render_class_map(small_version, PATCH_SIZE)
+    _, t = timed(res.tiffsave, path_output, compression="jpeg", xres=xres, yres=yres,
+                 tile=True, tile_width=PATCH_SIZE[0], tile_height=PATCH_SIZE[1],
+                 pyramid=True, bigtiff=True)
+    results["tiffsave"] = {"seconds": t}
+    os.remove(path_output)
+    return results
+
+def benchmark_tiles(slide, img, tiles, sample, model=None):
+    # Tile reading, stain normalization and inference of the sampled tissue tiles
+    results = {}
+    # Tile reading: decoding of tissue tiles
+    tile_index = dict(zip(sample["sample"], zip(sample["x"], sample["y"])))
+    batch = []
+    time_start = time.time()
+    for s in sample["sample"]:
+        tile = tile_loader(s, None, slide_img=img, tile_index=tile_index,
+                           patch_size=PATCH_SIZE)
+        # Keep a subsampled copy (256x256) for the stain normalization stage
+        batch.append(tile[::PATCH_SIZE[1] // 256, ::PATCH_SIZE[0] // 256])
+    t = time.time() - time_start
+    results["tile_reading"] = {"seconds": t, "tiles": len(sample),
+                               "tiles_per_sec": len(sample) / max(t, 1e-9)}
+    # Tile reading from the pyramid level closest to the model input (224x224)
+    img_level, factor = open_slide(slide).level(PATCH_SIZE[0] // 224)
+    read_size = (PATCH_SIZE[0] // factor, PATCH_SIZE[1] // factor)
+    time_start = time.time()
+    for s in sample["sample"]:
+        tile_loader(s, None, slide_img=img_level, tile_index=tile_index,
+                    patch_size=read_size)
+    t = time.time() - time_start
+    results["tile_reading_level"] = {"seconds": t, "tiles": len(sample),
+                                     "downsample": factor,
+                                     "tiles_per_sec": len(sample) / max(t, 1e-9)}
+    del img_level
+    # Stain normalization at (approximately) model input resolution
+    # (requires AUCMEDI, thus skipped on machines without it)
+    batch = np.stack(batch, axis=0)
+    try : from stain_normalization import StainNormalization
+    except ImportError : StainNormalization = None
+    if StainNormalization is not None:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        sf = StainNormalization(Image.open(os.path.join(dir_path,
+                                                        "stainnormalize_target.png")))
+        _, t = timed(sf.transform_batch, batch)
+        results["stain_normalization"] = {"seconds": t, "tiles": len(batch),
+                                          "tiles_per_sec": len(batch) / max(t, 1e-9)}
+    del batch
+    # Inference including preprocessing
+    if model is not None:
+        from model import run_aucmedi, background_predictions
+        # AUCMEDI DataGenerator and tf.data input pipeline
+        for pipeline, stage in [("aucmedi", "inference"),
+                                ("tfdata", "inference_tfdata")]:
+            config = {"nclasses": len(COL_NAMES), "patch_size": PATCH_SIZE,
+                      "slide_image": img, "tiles": sample,
+                      "input_pipeline": pipeline, "batch_size": args.batch_size}
+            df_res, t = timed(run_aucmedi, list(sample["sample"]), model, config)
+            results[stage] = {"seconds": t, "tiles": len(sample),
+                              "tiles_per_sec": len(sample) / max(t, 1e-9)}
+            if pipeline == "aucmedi" : df_dense, time_dense = df_res, t
+        # Adaptive sparse inference compared to dense scoring of the same tiles
+        config["input_pipeline"] = "aucmedi"
+        known = background_predictions(tiles.loc[~tiles["tissue"], "sample"])
+        df_res, t = timed(run_adaptive, list(sample["sample"]), tiles,
+                          lambda x: run_aucmedi(x, model, config), known=known,
+                          stride=args.adaptive_stride)
+        results["inference_adaptive"] = adaptive_report(df_res, df_dense, t, time_dense)
+        results["inference_adaptive"]["seconds"] = t
+    # Throughput of inference replicas pinned to disjoint core sets
+    if args.replica_sweep is not None:
+        results["inference_replicas"] = replica_sweep(slide, sample)
+    return results
+
+def replica_sweep(slide, sample):
+    """ Measure the throughput for each number of replicas and thread split.
+
+    Intra-op threads of each replica equal the cores of its core set. Replicas and
+    inter-op thread counts exceeding the available cores are skipped.
+    """
+    from replicas import ReplicaPool
+    settings = {"models": [args.model], "nclasses": len(COL_NAMES),
+                "backend": "keras", "threads": None, "aggregate": "mean",
+                "ensemble_weights": None, "cascade": None,
+                "cascade_threshold": None, "cascade_criterion": None,
+                "load_weights": not args.random_weights}
+    config = {"nclasses": len(COL_NAMES), "patch_size": PATCH_SIZE, "tiles": sample,
+              "slide_path": slide, "read_downsample": 1,
+              "batch_size": args.batch_size}
+    x = list(sample["sample"])
+    cores = len(os.sched_getaffinity(0))
+    runs = []
+    for replicas in [int(k) for k in args.replica_sweep.split(",")]:
+        for inter_op in [int(k) for k in args.sweep_inter_op.split(",")]:
+            if replicas > cores or inter_op > cores // replicas : continue
+            pool = ReplicaPool(settings, replicas=replicas, inter_op=inter_op,
+                               chunk_size=args.batch_size)
+            # Warm-up run to exclude the initialization of the replicas from timing
+            pool.predict(x[:replicas * args.batch_size], config)
+            _, t = timed(pool.predict, x, config)
+            runs.append({"replicas": replicas, "intra_op": len(pool.core_sets[0]),
+                         "inter_op": inter_op, "seconds": t,
+                         "tiles_per_sec": len(x) / max(t, 1e-9)})
+            pool.close()
+            print(json.dumps(runs[-1]))
+    best = max(runs, key=lambda r: r["tiles_per_sec"]) if len(runs) > 0 else None
+    return {"cores": cores, "runs": runs, "best": best}
+
+def startup_times(path_model, path_snapshot=None, repeats=3):
+    # Wall time of fresh processes including all imports (best of several runs)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    load = "import sys; sys.path.insert(0, %r); from model import load_model; " + \
+           "load_model(%r, %d, backend=%r)"
+    commands = {"help": [sys.executable, os.path.join(dir_path, "main.py"), "--help"],
+                "load_keras": [sys.executable, "-c", load % (dir_path, path_model,
+                                                             len(COL_NAMES), "keras")]}
+    if path_snapshot is not None:
+        commands["load_snapshot"] = [sys.executable, "-c",
+                                     load % (dir_path, path_snapshot,
+                                             len(COL_NAMES), "snapshot")]
+    results = {}
+    for name, cmd in commands.items():
+        times = []
+        for _ in range(repeats):
+            time_start = time.time()
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            times.append(time.time() - time_start)
+        results[name] = {"seconds": min(times)}
+    return results
+
+# -----------------------------------------------------#
+#                      Main Script                     #
+# -----------------------------------------------------#
+model = None
+if not args.skip_inference:
+    from model import load_model
+    model = load_model(args.model, len(COL_NAMES),
+                       load_weights=not args.random_weights)
+
+path_cache = args.cache
+if path_cache is None:
+    tmp_cache = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+    path_cache = tmp_cache.name
+if not os.path.exists(path_cache) : os.makedirs(path_cache)
+
+report = {
+    "libvips": "{}.{}.{}".format(pyvips.version(0), pyvips.version(1),
+                                 pyvips.version(2)),
+    "model": None if model is None else model.arch_name,
+    "random_weights": args.random_weights,
+    "max_tiles": args.max_tiles,
+    "slides": [],
+}
+if args.startup:
+    report["startup"] = startup_times(args.model, args.snapshot)
+    print(json.dumps(report["startup"]))
+for n_tiles in [int(n) for n in args.sizes.split(",")]:
+    path_slide = os.path.join(path_cache, "synthetic_%d.tiff" % n_tiles)
+    if not os.path.exists(path_slide):
+        _, t = timed(synthetic_slide, path_slide, n_tiles)
+        print("Generated synthetic slide with", n_tiles, "tiles in %.1fs" % t)
+    results = benchmark_slide(path_slide, model)
+    print(json.dumps(results))
+    report["slides"].append(results)
+
+with open(args.output, "w") as writer:
+    json.dump(report, writer, indent=2)
+print("Stored benchmark results:", args.output)
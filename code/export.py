@@ -0,0 +1,175 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from model import load_model, build_generator, run_aucmedi, export_snapshot
+from proc import gen_tiles, COL_NAMES
+
+# -----------------------------------------------------#
+#                     CLI Argparser                    #
+# -----------------------------------------------------#
+parser = argparse.ArgumentParser(description="DeepGleason: Model Export")
+parser.add_argument(
+    "--model",
+    help="Path to the Keras model weights (e.g. models/model.DenseNet121.hdf5)",
+    dest="model",
+    required=True,
+    type=str,
+)
+parser.add_argument(
+    "--mode",
+    help="TFLite post-training quantization mode or pre-traced model snapshot " + \
+         "(SavedModel) for fast startup",
+    dest="mode",
+    choices=["float32", "float16", "dynamic", "int8", "snapshot"],
+    default="float16",
+    required=False,
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    help="Path of the exported model. Default: model.<architecture>.<mode>.tflite " + \
+         "(or model.<architecture>.savedmodel) next to the Keras model",
+    dest="output",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--slide",
+    help="Slide providing sample tiles for int8 calibration and the evaluation",
+    dest="slide",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--samples",
+    help="Number of sample tiles drawn from the slide",
+    dest="samples",
+    default=256,
+    required=False,
+    type=int,
+)
+parser.add_argument(
+    "--evaluate",
+    help="Benchmark the exported model against the Keras model on the sample tiles",
+    dest="evaluate",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "--threads",
+    help="Number of threads of the TFLite interpreter during evaluation",
+    dest="threads",
+    default=None,
+    required=False,
+    type=int,
+)
+args = parser.parse_args()
+
+PATCH_SIZE = (1024, 1024)
+
+# -----------------------------------------------------#
+#                   Sample Tiles                       #
+# -----------------------------------------------------#
+def sample_tiles(slide, n_samples):
+    # Draw random tissue tiles of a slide for in-memory inference
+    slide_name = os.path.basename(slide)
+    slide_name = slide_name[: slide_name.find(".")]
+    img, tiles, _, _, _, _, _ = gen_tiles(None, slide, slide_name, PATCH_SIZE, 0.05)
+    tiles = tiles[tiles["tissue"]]
+    tiles = tiles.sample(n=min(n_samples, len(tiles)), random_state=0)
+    config = {"nclasses": len(COL_NAMES), "patch_size": PATCH_SIZE,
+              "slide_image": img, "tiles": tiles}
+    return list(tiles["sample"]), config
+
+# -----------------------------------------------------#
+#                        Export                        #
+# -----------------------------------------------------#
+model = load_model(args.model, len(COL_NAMES))
+
+if args.slide is not None : x, config = sample_tiles(args.slide, args.samples)
+elif args.mode == "int8" or args.evaluate:
+    parser.error("--slide is required for int8 calibration and evaluation")
+
+path_output = args.output
+if args.mode == "snapshot":
+    if path_output is None:
+        path_output = os.path.join(os.path.dirname(args.model), "model." + \
+                                   model.arch_name + ".savedmodel")
+    export_snapshot(model, path_output)
+    print("Exported model snapshot:", path_output)
+else:
+    converter = tf.lite.TFLiteConverter.from_keras_model(model.model)
+    if args.mode != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if args.mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif args.mode == "int8":
+        # Calibrate activation ranges on preprocessed sample tiles
+        def representative_dataset():
+            gen = build_generator(x, model, config)
+            for i in range(len(gen)):
+                batch = gen[i]
+                if isinstance(batch, tuple) : batch = batch[0]
+                for img in batch:
+                    yield [img[np.newaxis].astype(np.float32)]
+        converter.representative_dataset = representative_dataset
+    tflite_model = converter.convert()
+
+    if path_output is None:
+        path_output = os.path.join(os.path.dirname(args.model), "model." + \
+                                   model.arch_name + "." + args.mode + ".tflite")
+    with open(path_output, "wb") as writer:
+        writer.write(tflite_model)
+    print("Exported TFLite model:", path_output)
+
+# -----------------------------------------------------#
+#                      Evaluation                      #
+# -----------------------------------------------------#
+if args.evaluate:
+    backend = "snapshot" if args.mode == "snapshot" else "tflite"
+    model_export = load_model(path_output, len(COL_NAMES), backend=backend,
+                              num_threads=args.threads)
+    results = {}
+    preds = {}
+    for name, m in [("keras", model), (backend, model_export)]:
+        # Warm-up run to exclude initialization from timing
+        run_aucmedi(x[:1], m, config)
+        time_start = time.time()
+        preds[name] = run_aucmedi(x, m, config)
+        time_total = time.time() - time_start
+        results[name] = {"tiles_per_sec": len(x) / time_total}
+    agree = preds["keras"]["class"] == preds[backend]["class"]
+    results["agreement"] = float(agree.mean())
+    results["agreement_per_class"] = {
+        c: float(agree[preds["keras"]["class"] == c].mean()) \
+        for c in COL_NAMES if (preds["keras"]["class"] == c).any()
+    }
+    results["max_abs_diff"] = float(np.max(np.abs(
+        preds["keras"][COL_NAMES].to_numpy() - preds[backend][COL_NAMES].to_numpy()
+    )))
+    print(json.dumps(results, indent=2))
@@ -19,17 +19,28 @@
 #                    Library imports                   #
 # -----------------------------------------------------#
 import os
-import math
-import tempfile
+import sys
+import time
+import json
 import argparse
 import logging
+import threading
 import pyvips
 import pandas as pd
-from tqdm import tqdm
-from aucmedi import input_interface
 
-from model import run_aucmedi
-from proc import gen_tiles, class_reassemble
+# TensorFlow & AUCMEDI (module model) are imported on first use in load_models()
+from proc import gen_tiles, tile_grid, class_reassemble, render_class_map
+from proc import save_class_map, probability_reassemble, save_grid_maps
+from proc import output_paths, is_output, COL_NAMES
+from adaptive import run_adaptive, adaptive_report
+from pipeline import Pipeline
+from replicas import ReplicaPool
+from slide_reader import SlideReader
+from scheduler import WorkQueue
+from store import PredictionStore
+from tile_cache import TileCache
+from result_cache import ResultCache, slide_hash, file_hash, result_key
+from metrics import Metrics
 
 # -----------------------------------------------------#
 #                     CLI Argparser                    #
@@ -47,15 +58,53 @@ parser.add_argument(
 
 parser.add_argument(
     "--cache",
-    help="The location for temporary files that care generated during generation",
+    help="Optional location for storing the tiles as PNG files (debugging). " + \
+         "By default, tiles are streamed in-memory from the slide",
     dest="cache",
     required=False,
     type=str,
-)  # Make TempDir default
+)
+parser.add_argument(
+    "--tile_cache",
+    help="Optional directory of a persistent cache of preprocessed tiles " + \
+         "(one memory-mapped array per slide), reused by all models with the " + \
+         "same input resolution and by re-runs",
+    dest="tile_cache",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--result_cache",
+    help="directory of the content-addressed cache of slide predictions " + \
+         "(keyed by slide content and model weights). " + \
+         "Default: results.cache in the output directory",
+    dest="result_cache",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--result_cache_size",
+    help="maximum size of the result cache in GB (least recently used " + \
+         "entries are evicted)",
+    dest="result_cache_size",
+    default=1.0,
+    required=False,
+    type=float,
+)
+parser.add_argument(
+    "--no_cache",
+    "--no-cache",
+    help="disable the result cache and always recompute predictions",
+    dest="no_cache",
+    action="store_true",
+    default=False,
+    required=False,
+)
 parser.add_argument(
     "-i",
     "--input",
-    help="Path to the input slide",
+    help="Path to the input slide, a directory of slides or a manifest " + \
+         "(.txt file with one slide path per line)",
     dest="input",
     action="append",
     required=True,
@@ -71,9 +120,188 @@ parser.add_argument(
 )
 parser.add_argument(
     "--model",
-    help="Model the XAI is computed upon",
+    help="Model the XAI is computed upon. Multiple models are combined to an " + \
+         "ensemble sharing tile decoding and stain normalization",
     dest="model",
-    default="model.hdf5",
+    default=["model.hdf5"],
+    nargs="+",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--aggregate",
+    help="aggregation of the ensemble predictions: mean, weighted mean " + \
+         "(see --ensemble_weights) or majority vote",
+    dest="aggregate",
+    choices=["mean", "weighted", "majority"],
+    default="mean",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--ensemble_weights",
+    help="weight of each model for --aggregate weighted (in order of --model)",
+    dest="ensemble_weights",
+    nargs="+",
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--backend",
+    help="inference backend: Keras model (.hdf5), TFLite model (.tflite) or " + \
+         "pre-traced model snapshot (.savedmodel) exported via code/export.py",
+    dest="backend",
+    choices=["keras", "tflite", "snapshot"],
+    default="keras",
+    required=False,
+)
+
+parser.add_argument(
+    "--threads",
+    help="number of threads of the TFLite interpreter",
+    dest="threads",
+    default=None,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--replicas",
+    help="number of inference replicas (processes) on CPU nodes, each pinned to " + \
+         "a disjoint set of the available cores and fed from a shared tile queue. " + \
+         "Default: inference in the main process",
+    dest="replicas",
+    default=None,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--intra_op_threads",
+    help="TensorFlow intra-op threads (per replica). Default: TensorFlow default " + \
+         "or the cores of each replica",
+    dest="intra_op_threads",
+    default=None,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--inter_op_threads",
+    help="TensorFlow inter-op threads (per replica). Default: TensorFlow default",
+    dest="inter_op_threads",
+    default=None,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--input_pipeline",
+    help="input pipeline feeding the model: AUCMEDI DataGenerator or tf.data " + \
+         "with autotuned parallelism and prefetching",
+    dest="input_pipeline",
+    choices=["aucmedi", "tfdata"],
+    default="aucmedi",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--batch_size",
+    help="number of tiles per batch",
+    dest="batch_size",
+    default=32,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--cascade",
+    help="cascade mode: fast screening model (e.g. models/model.DenseNet121.hdf5) " + \
+         "scoring all tiles, uncertain tiles are re-scored by --model",
+    dest="cascade",
+    default=None,
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--cascade_threshold",
+    help="confidence below which a screening prediction is re-scored",
+    dest="cascade_threshold",
+    default=0.9,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--cascade_criterion",
+    help="confidence measure of the screening model",
+    dest="cascade_criterion",
+    choices=["maxprob", "margin"],
+    default="maxprob",
+    required=False,
+)
+
+parser.add_argument(
+    "--cascade_report",
+    help="additionally run --model on all tiles and report speedup and agreement",
+    dest="cascade_report",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--adaptive_stride",
+    help="adaptive sparse inference: score every STRIDE-th tile in both directions " + \
+         "(density 1/STRIDE²), refine tiles whose neighbours disagree or are " + \
+         "uncertain and fill the remaining tiles from their neighbours",
+    dest="adaptive_stride",
+    default=None,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--adaptive_threshold",
+    help="confidence of a neighbour below which adjacent tiles are scored",
+    dest="adaptive_threshold",
+    default=0.9,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--adaptive_rounds",
+    help="maximum number of refinement rounds of the adaptive inference",
+    dest="adaptive_rounds",
+    default=10,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--adaptive_report",
+    help="additionally score all tiles densely and report scored tiles, speedup " + \
+         "and agreement of the adaptive inference",
+    dest="adaptive_report",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--output_format",
+    help="output of each slide: full-resolution class map (full, JPEG " + \
+         "compressed pyramidal BigTIFF), lossless class & probability maps at " + \
+         "tile grid resolution (grid) or both",
+    dest="output_format",
+    choices=["full", "grid", "both"],
+    default="full",
     required=False,
     type=str,
 )
@@ -87,10 +315,208 @@ parser.add_argument(
     required=False,
 )
 
+parser.add_argument(
+    "--soft_overlay",
+    help="blend class colors by the predicted probabilities instead of the argmax class",
+    dest="soft_overlay",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--tissue_threshold",
+    help="Minimum tissue fraction of a tile to be passed to the model. " + \
+         "Tiles below are directly classified as Artefact Empty (A_D)",
+    dest="tissue_threshold",
+    default=0.05,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--no_prefilter",
+    help="disable the tissue/background prefilter and pass all tiles to the model",
+    dest="no_prefilter",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--stain_full_resolution",
+    help="apply stain normalization on the full tile instead of the resized model input",
+    dest="stain_full_resolution",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--read_model_resolution",
+    help="read tiles from the slide pyramid level closest to the model input " + \
+         "resolution instead of the full resolution",
+    dest="read_model_resolution",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--watch",
+    help="serve mode: keep the model loaded and process new slides " + \
+         "appearing in the input directory",
+    dest="watch",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
+parser.add_argument(
+    "--poll_interval",
+    help="seconds between scans of the input directory in serve mode",
+    dest="poll_interval",
+    default=10.0,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--scheduler",
+    help="shared work directory coordinating multiple workers: slides are " + \
+         "claimed via lock files (largest first) and their status is recorded",
+    dest="scheduler",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--heartbeat",
+    help="seconds between heartbeats of the slide locks held by this worker",
+    dest="heartbeat",
+    default=30.0,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--stale_timeout",
+    help="seconds without heartbeat after which the lock of a crashed worker " + \
+         "is recovered",
+    dest="stale_timeout",
+    default=300.0,
+    required=False,
+    type=float,
+)
+
+parser.add_argument(
+    "--workers_reader",
+    help="number of parallel slides being tiled ahead of the inference",
+    dest="workers_reader",
+    default=1,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--workers_writer",
+    help="number of parallel slides being written after the inference",
+    dest="workers_writer",
+    default=1,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--queue_size",
+    help="maximum number of slides waiting between two pipeline stages",
+    dest="queue_size",
+    default=1,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--shard",
+    help="process only a band of tile rows of each slide given as INDEX/COUNT " + \
+         "(e.g. 0/4). Partial predictions are merged via code/merge.py",
+    dest="shard",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--tile_range",
+    help="process only an explicit range of tiles of each slide given as " + \
+         "START:END (in tile grid order). Partial predictions are merged via " + \
+         "code/merge.py",
+    dest="tile_range",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--checkpoint_interval",
+    help="number of tiles after which predictions are checkpointed for resuming",
+    dest="checkpoint_interval",
+    default=2048,
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--store",
+    help="directory of the append-only prediction store (one Feather file per " + \
+         "slide). Default: predictions.store in the output directory",
+    dest="store",
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--metrics",
+    help="JSON lines file for per-stage run metrics (wall/CPU time, tiles/sec, " + \
+         "peak RSS, bytes read/written, libvips progress)",
+    dest="metrics",
+    default=None,
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--metrics_prometheus",
+    help="Prometheus text file updated with the latest run metrics",
+    dest="metrics_prometheus",
+    default=None,
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--profile",
+    help="name of a slide for which cProfile dumps of all stages are stored " + \
+         "in the output directory",
+    dest="profile",
+    default=None,
+    required=False,
+    type=str,
+)
+
+parser.add_argument(
+    "--profile_tf",
+    help="additionally record a TensorFlow profile of the inference of --profile",
+    dest="profile_tf",
+    action="store_true",
+    default=False,
+    required=False,
+)
+
 parser.add_argument(
     "-p",
     "--predictions",
-    help="output CSV containing predicted soft labels",
+    help="output CSV containing predicted soft labels of all slides in the " + \
+         "prediction store (exported after all slides are processed, in serve " + \
+         "mode after each slide)",
     dest="prediction",
     required=False,
     type=str,
@@ -108,30 +534,104 @@ os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
 PATCH_SIZE = (1024, 1024)
 
 STORE_PREDICTIONS = not (args.prediction is None)
-APPEND_PREDICTIONS = os.path.exists(args.prediction)
 PREDICTION_PATH = args.prediction
 
 INPUTS = args.input
-if os.path.isdir(INPUTS[0]) : INPUTS = [os.path.join(INPUTS[0], x) for x in os.listdir(INPUTS[0])]
+if os.path.isdir(INPUTS[0]):
+    INPUTS = [os.path.join(INPUTS[0], x) for x in os.listdir(INPUTS[0])]
+    # Stores, caches and outputs may be located in the input directory
+    INPUTS = [x for x in INPUTS if os.path.isfile(x) and not is_output(x)]
+else:
+    if INPUTS[0].endswith(".txt"):
+        if not os.path.isfile(INPUTS[0]) : parser.error("manifest not found: " + INPUTS[0])
+        with open(INPUTS[0], "r") as f:
+            INPUTS = [l.strip() for l in f if l.strip() != ""]
+    # Explicitly given slides have to exist
+    missing = [x for x in INPUTS if not os.path.isfile(x)]
+    if len(missing) > 0 : parser.error("input slides not found: " + ", ".join(missing))
+if args.watch and not os.path.isdir(args.input[0]):
+    parser.error("--watch requires a directory as input")
+if not args.watch and len(INPUTS) == 0 : parser.error("no input slides found")
 
 RES_PATH = args.output  # location of full slides
 if not os.path.exists(RES_PATH):
     os.mkdir(RES_PATH)
 
-BASE_PATH = args.cache  # cache base path
-TEMP_CACHE = False
-if BASE_PATH is None:
-    BASE_PATH = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.").name
-    TEMP_CACHE = True
+# Machine-readable run metrics
+metrics = Metrics(args.metrics, args.metrics_prometheus, profile=args.profile,
+                  profile_tf=args.profile_tf, profile_dir=RES_PATH)
+
+# Append-only prediction store with one shard per slide
+STORE_PATH = args.store
+if STORE_PATH is None : STORE_PATH = os.path.join(RES_PATH, "predictions.store")
+store = PredictionStore(STORE_PATH)
+export_lock = threading.Lock()
 
-if not os.path.exists(BASE_PATH):
+BASE_PATH = args.cache  # cache base path (only used for debugging)
+IN_MEMORY = BASE_PATH is None
+if not IN_MEMORY and not os.path.exists(BASE_PATH):
     os.mkdir(BASE_PATH)
 
+# Persistent cache of preprocessed tiles
+tile_cache = None
+if args.tile_cache is not None : tile_cache = TileCache(args.tile_cache)
+
 MODEL = args.model
 
+# Models are loaded on first use (see load_models)
+inference, model, model_screen = None, None, None
+replica_pool = None
+models_lock = threading.Lock()
+READ_DOWNSAMPLE = 1
+
+# Content-addressed cache of slide predictions
+result_cache = None
+MODEL_HASH = None
+model_hash_lock = threading.Lock()
+if not args.no_cache:
+    RESULT_CACHE_PATH = args.result_cache
+    if RESULT_CACHE_PATH is None:
+        RESULT_CACHE_PATH = os.path.join(RES_PATH, "results.cache")
+    result_cache = ResultCache(RESULT_CACHE_PATH,
+                               max_size=int(args.result_cache_size * 1024**3))
+    # Predictions depend on the model weights and the inference configuration
+    RESULT_CONFIG = {"backend": args.backend, "aggregate": args.aggregate,
+                     "ensemble_weights": args.ensemble_weights,
+                     "cascade_threshold": args.cascade_threshold,
+                     "cascade_criterion": args.cascade_criterion,
+                     "adaptive_stride": args.adaptive_stride,
+                     "adaptive_threshold": args.adaptive_threshold,
+                     "adaptive_rounds": args.adaptive_rounds,
+                     "tissue_threshold": None if args.no_prefilter else \
+                                         args.tissue_threshold,
+                     "stain_full_resolution": args.stain_full_resolution,
+                     "read_model_resolution": args.read_model_resolution,
+                     "input_pipeline": args.input_pipeline,
+                     "shard": args.shard, "tile_range": args.tile_range}
+
+CHECKPOINT_INTERVAL = args.checkpoint_interval
+
+TISSUE_THRESHOLD = None if args.no_prefilter else args.tissue_threshold
+
+# Shard of the tile grid processed by this process (partial predictions)
+SHARD, TILE_RANGE, PART = None, None, None
+if args.shard is not None:
+    SHARD = tuple(int(v) for v in args.shard.split("/"))
+    if len(SHARD) != 2 or not 0 <= SHARD[0] < SHARD[1]:
+        parser.error("--shard requires INDEX/COUNT with 0 <= INDEX < COUNT")
+    PART = "%d-of-%d" % SHARD
+elif args.tile_range is not None:
+    TILE_RANGE = tuple(int(v) for v in args.tile_range.split(":"))
+    if len(TILE_RANGE) != 2 or not 0 <= TILE_RANGE[0] < TILE_RANGE[1]:
+        parser.error("--tile_range requires START:END with 0 <= START < END")
+    PART = "tiles-%d-%d" % TILE_RANGE
+
+# Coordination of multiple workers on a shared work directory
+work_queue = None
+if args.scheduler is not None:
+    work_queue = WorkQueue(args.scheduler, heartbeat=args.heartbeat,
+                           stale_timeout=args.stale_timeout, part=PART)
 
-config = {}
-COL_NAMES = ["A_S", "A_D", "R", "G3", "G4", "G5"]
 
 # pyvips.cache_set_max_mem(0) #This may be necessary to cache operations. 
 # On the other hand this is incredibly useful to accelerate null computations
@@ -142,85 +642,352 @@ print(
 )
 
 #------------------------------------------------------#
-#                      Main Script                     #
+#                   Slide Processing                   #
 #------------------------------------------------------#
-for i, slide in enumerate(INPUTS):
+def load_models():
+    """ Import the inference libraries and load the models on first use.
+
+    Deferred until a slide actually requires inference, so that --help and runs
+    skipping all slides do not pay for importing TensorFlow and AUCMEDI.
+    Models are kept resident for all further slides.
+    """
+    global inference, model, model_screen, tile_cache, replica_pool, READ_DOWNSAMPLE
+    with models_lock:
+        if model is not None : return
+        import model as inference
+        inference.configure_threads(args.intra_op_threads, args.inter_op_threads)
+        # Replicas load their own weights, the models of the main process only
+        # provide the input resolution and stain normalization (e.g. tile cache)
+        load_weights = args.replicas is None
+        models = [inference.load_model(m, len(COL_NAMES), backend=args.backend,
+                                       num_threads=args.threads,
+                                       load_weights=load_weights) for m in MODEL]
+        model_main = models[0]
+        if len(models) > 1:
+            model_main = inference.Ensemble(models, aggregate=args.aggregate,
+                                            weights=args.ensemble_weights)
+        if args.cascade is not None:
+            model_screen = inference.load_model(args.cascade, len(COL_NAMES),
+                                                backend=args.backend,
+                                                num_threads=args.threads,
+                                                load_weights=load_weights)
+            # The tile cache holds tiles at a single input resolution
+            if tile_cache is not None and \
+                model_screen.meta_input != model_main.meta_input:
+                print("Tile cache disabled: models differ in input resolution")
+                tile_cache = None
+        # Downsampling factor for reading tiles near the model input resolution
+        # (the model with the largest input decides to avoid upsampling)
+        if args.read_model_resolution:
+            models_input = [m.meta_input[0] for m in [model_main, model_screen] \
+                            if m is not None]
+            READ_DOWNSAMPLE = PATCH_SIZE[0] // max(models_input)
+        if args.replicas is not None:
+            settings = {"models": MODEL, "nclasses": len(COL_NAMES),
+                        "backend": args.backend, "threads": args.threads,
+                        "aggregate": args.aggregate,
+                        "ensemble_weights": args.ensemble_weights,
+                        "cascade": args.cascade,
+                        "cascade_threshold": args.cascade_threshold,
+                        "cascade_criterion": args.cascade_criterion,
+                        "load_weights": True}
+            replica_pool = ReplicaPool(settings, replicas=args.replicas,
+                                       intra_op=args.intra_op_threads,
+                                       inter_op=args.inter_op_threads,
+                                       chunk_size=4 * args.batch_size)
+            print("Started", args.replicas, "inference replicas on cores",
+                  replica_pool.core_sets)
+        model = model_main
+
+def model_hash():
+    # Hashing the weights is deferred, so that runs without cache lookups skip it
+    global MODEL_HASH
+    with model_hash_lock:
+        if MODEL_HASH is None:
+            MODEL_HASH = file_hash(MODEL + ([args.cascade] if args.cascade else []))
+        return MODEL_HASH
+
+def get_slide_name(slide):
     slide_name = os.path.basename(slide)
-    slide_name = slide_name[: slide_name.find(".")]
-    patch_path = os.path.join(BASE_PATH, slide_name)
-    if not os.path.exists(patch_path):
-        os.mkdir(patch_path)
-    if not os.path.exists(os.path.join(RES_PATH, slide_name + "_gleason.tiff")):
-        print("Loaded Tiff:", slide)
-        max_X, max_Y, xres, yres = gen_tiles(patch_path, slide, slide_name, PATCH_SIZE)
-        print("Generated Patches for Model")
+    return slide_name[: slide_name.find(".")]
+
+def instrument(stage, func):
+    # Record metrics of a pipeline stage for each slide
+    def run_stage(item):
+        slide = item if isinstance(item, str) else item["slide"]
+        with metrics.stage(get_slide_name(slide), stage) as record:
+            res = func(item)
+            # Only the reader stage skips slides (the writer returns nothing)
+            if stage == "tiling":
+                if res is None : record["skipped"] = True
+                else : record["tiles"] = len(res["tissue"]) + len(res["background"])
+            elif stage == "inference":
+                record["tiles"] = len(res["tissue"])
+        return res
+    return run_stage
+
+def read_slide(slide):
+    slide_name = get_slide_name(slide)
+    if all(os.path.exists(p) for p in output_paths(RES_PATH, slide_name,
+                                                   args.output_format)):
+        print("Skipping slide:", slide, "- Already output file existing!")
+        if work_queue is not None : work_queue.release(slide, "skipped")
+        return None
+    # Partial predictions are stored under the name of the shard
+    store_name = slide_name
+    if PART is not None:
+        store_name = store.partial_name(slide_name, PART)
+        if store.contains(store_name):
+            print("Skipping slide:", slide, "- Already shard existing!")
+            if work_queue is not None : work_queue.release(slide, "skipped")
+            return None
+    # Slide is opened once and the handle is shared by all stages
+    reader = SlideReader(slide)
+    # Skip inference for slides with cached predictions
+    cache_key, slide_digest = None, None
+    if result_cache is not None:
+        slide_digest = slide_hash(reader)
+        cache_key = result_key(slide_digest, model_hash(), RESULT_CONFIG)
+        df_cached = result_cache.get(cache_key)
+        if df_cached is not None:
+            job = cached_slide(reader, slide_name, df_cached, cache_key)
+            job["store_name"] = store_name
+            return job
+    patch_path = None
+    if not IN_MEMORY:
+        patch_path = os.path.join(BASE_PATH, store_name)
+        if not os.path.exists(patch_path):
+            os.mkdir(patch_path)
 
-        # generate predictions and XAI
-        io = input_interface(
-            "directory",
-            path_imagedir=patch_path,
-            path_data=None,
-            training=False,
-            ohe=False,
-        )
-        (x, _, _, _, image_format) = io
-        config["nclasses"] = len(COL_NAMES)
-        config["image_format"] = image_format
+    load_models()
+    print("Loaded Tiff:", slide)
+    img, tiles, max_X, max_Y, xres, yres, read_size = gen_tiles(
+        patch_path, reader, slide_name, PATCH_SIZE, TISSUE_THRESHOLD,
+        downsample=READ_DOWNSAMPLE, shard=SHARD, tile_range=TILE_RANGE)
+    tissue = tiles[tiles["tissue"]]
+    background = tiles[~tiles["tissue"]]
+    print("Tissue Prefilter: skipped", len(background), "of", len(tiles),
+          "tiles as background")
+
+    config = {}
+    config["nclasses"] = len(COL_NAMES)
+    config["patch_size"] = read_size
+    config["stain_full_resolution"] = args.stain_full_resolution
+    config["input_pipeline"] = args.input_pipeline
+    config["batch_size"] = args.batch_size
+    if IN_MEMORY:
+        config["slide_image"] = img
+        config["tiles"] = tissue
+        # Inference replicas reopen the slide at the same resolution
+        config["slide_path"] = slide
+        config["read_downsample"] = READ_DOWNSAMPLE
+        if tile_cache is not None:
+            if slide_digest is None : slide_digest = slide_hash(reader)
+            use_tile_cache(store_name, tissue, config, slide_digest)
+    else:
+        print("Generated Patches for Model")
+        config["image_format"] = "png"
         config["path_images"] = patch_path
 
-        df_res = run_aucmedi(x, MODEL, config)
-
-        print("aucmedi prediction completed")
-        # store predictions
-        if STORE_PREDICTIONS:
-            if APPEND_PREDICTIONS:
-                df_res = pd.concat(
-                    [pd.read_csv(PREDICTION_PATH), df_res], ignore_index=True
-                )
-            df_res.to_csv(PREDICTION_PATH)
-
-        df_res.set_index("sample", inplace=True)
-
-        if not os.path.exists(os.path.join(RES_PATH, slide_name + "_gleason.tiff")):
-            os.environ["VIPS_CONCURRENCY"] = "1"
-            res = pyvips.Image.new_from_array(
-                class_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE),
-                interpretation="rgb",
-            )
-            res = res.resize(PATCH_SIZE[0], kernel="nearest", vscale=PATCH_SIZE[1])
-            res = res.rot270()
-            res = res.flipver()
-            img = None
-            if args.gen_overlay:
-                img_r = pyvips.Image.new_from_file(slide, page=0)
-                img_g = pyvips.Image.new_from_file(slide, page=1)
-                img_b = pyvips.Image.new_from_file(slide, page=2)
-
-                img = img_r.bandjoin([img_g, img_b])
-                img = img.copy(interpretation="rgb")
-
-                res *= 0.3
-                img *= 0.7
-
-                res += img
-
-            props = {
-                "compression": "jpeg",
-                "xres": xres,
-                "yres": yres,
-                "tile": True,
-                "tile_width": PATCH_SIZE[0],
-                "tile_height": PATCH_SIZE[1],
-                "pyramid": True,
-                "bigtiff": True,
-            }
-            res.tiffsave(os.path.join(RES_PATH, slide_name + "_gleason.tiff"), **props)
-            del res
-    else : print("Skipping slide:", slide, "- Already output file existing!")
+    return {"slide": slide, "slide_name": slide_name, "store_name": store_name,
+            "patch_path": patch_path, "tissue": tissue, "background": background, "config": config,
+            "max_X": max_X, "max_Y": max_Y, "xres": xres, "yres": yres,
+            "reader": reader, "read_size": read_size, "cache_key": cache_key}
+
+def cached_slide(reader, slide_name, df_cached, cache_key):
+    # Restore sample names of the cached predictions from the tile grid
+    print("Result cache hit:", reader.path)
+    max_X = reader.width - (reader.width % PATCH_SIZE[0])
+    max_Y = reader.height - (reader.height % PATCH_SIZE[1])
+    tiles = tile_grid(max_X, max_Y, slide_name, PATCH_SIZE)
+    df_res = df_cached.merge(tiles, on=["x", "y"], how="inner")
+    return {"slide": reader.path, "slide_name": slide_name, "patch_path": None,
+            "tissue": tiles.iloc[:0], "background": tiles.iloc[:0], "config": {},
+            "max_X": max_X, "max_Y": max_Y, "xres": reader.xres,
+            "yres": reader.yres, "reader": reader, "read_size": PATCH_SIZE,
+            "cache_key": cache_key, "df_res": df_res}
+
+def use_tile_cache(slide_name, tissue, config, slide_digest):
+    # Preprocess tiles once, afterwards they are loaded memory-mapped from the cache
+    # (entries are only reused for the same slide content and preprocessing)
+    settings = {"slide_hash": slide_digest,
+                "patch_size": list(config["patch_size"]),
+                "read_downsample": config["read_downsample"],
+                "stain_full_resolution": config["stain_full_resolution"]}
+    if not tile_cache.contains(slide_name, model.meta_input, tissue["sample"],
+                               settings):
+        print("Caching preprocessed tiles:", slide_name)
+        inference.cache_tiles(tissue, model, config, tile_cache, slide_name,
+                              settings)
+    cache_array, cache_index = tile_cache.open(slide_name, model.meta_input)
+    config["cache_tiles"] = cache_array
+    config["cache_index"] = dict(zip(cache_index["sample"],
+                                     range(len(cache_index))))
+    config["cache_entry"] = [tile_cache.path, slide_name, list(model.meta_input)]
+
+def predict_tiles(x, config):
+    if replica_pool is not None : return replica_pool.predict(x, config)
+    if model_screen is None : return inference.run_aucmedi(x, model, config)
+    return inference.run_cascade(x, model_screen, model, config,
+                       threshold=args.cascade_threshold,
+                       criterion=args.cascade_criterion)
+
+def predict_slide(job):
+    slide_name = job["slide_name"]
+    # Predictions restored from the result cache
+    if "df_res" in job : return job
+    # Resume from tiles which have already been scored before an interruption
+    df_done, x = store.resume(job["store_name"], list(job["tissue"]["sample"]))
+    if len(df_done) > 0:
+        print("Resuming slide:", job["slide"], "-", len(df_done),
+              "tiles already scored")
+    tiles = pd.concat([job["tissue"], job["background"]])
+    # generate predictions in chunks and checkpoint them after each chunk
+    def predict_chunks(x_chunks):
+        df_chunks = []
+        for i in range(0, len(x_chunks), CHECKPOINT_INTERVAL):
+            df_chunk = predict_tiles(x_chunks[i:i+CHECKPOINT_INTERVAL], job["config"])
+            store.append_progress(job["store_name"], df_chunk)
+            df_chunks.append(df_chunk)
+        return pd.concat(df_chunks, ignore_index=True)
+    df_list = [df_done,
+               inference.background_predictions(job["background"]["sample"])]
+    time_start = time.time()
+    if args.adaptive_stride is not None:
+        # Scored neighbours include background tiles and resumed tiles
+        df_adaptive = run_adaptive(x, tiles[["sample", "x", "y"]], predict_chunks,
+                                   known=pd.concat(df_list, ignore_index=True),
+                                   stride=args.adaptive_stride,
+                                   threshold=args.adaptive_threshold,
+                                   max_rounds=args.adaptive_rounds)
+        df_list.append(df_adaptive)
+        print("Adaptive inference: scored",
+              int((df_adaptive["model"] != "interpolated").sum()), "of", len(x),
+              "tiles")
+    elif len(x) > 0 : df_list.append(predict_chunks(x))
+    time_pred = time.time() - time_start
+    df_res = pd.concat(df_list, ignore_index=True)
+
+    # Compare cascade with a full run of the main model
+    if model_screen is not None and args.cascade_report and len(x) > 0:
+        time_start = time.time()
+        if replica_pool is not None:
+            df_full = replica_pool.predict(x, dict(job["config"], full_model=True))
+        else : df_full = inference.run_aucmedi(x, model, job["config"])
+        time_full = time.time() - time_start
+        report = inference.cascade_report(pd.concat(df_list[2:]), df_full, time_pred, time_full)
+        print("Cascade report:", slide_name, json.dumps(report))
+    # Compare adaptive inference with dense scoring of all tiles
+    if args.adaptive_stride is not None and args.adaptive_report and len(x) > 0:
+        time_start = time.time()
+        df_dense = predict_tiles(x, job["config"])
+        time_dense = time.time() - time_start
+        report = adaptive_report(df_list[2], df_dense, time_pred, time_dense)
+        print("Adaptive report:", slide_name, json.dumps(report))
+    job["config"].pop("slide_image", None)
+    job["config"].pop("cache_tiles", None)
+    # Carry integer grid coordinates of each tile
+    df_res = df_res.merge(tiles[["sample", "x", "y"]], on="sample", how="left")
+    job["df_res"] = df_res
+    if job["cache_key"] is not None : result_cache.put(job["cache_key"], df_res)
+    print("aucmedi prediction completed:", job["slide"])
+    return job
+
+def write_slide(job):
+    slide = job["slide"]
+    slide_name = job["slide_name"]
+    df_res = job["df_res"]
+    # store predictions
+    store.append(job["store_name"], df_res)
+    store.clear_progress(job["store_name"])
+
+    # Output of a sharded slide is written after merging all shards
+    paths_output = output_paths(RES_PATH, slide_name, args.output_format)
+    if PART is None and not all(os.path.exists(p) for p in paths_output):
+        small_version = class_reassemble(job["max_X"], job["max_Y"], slide_name,
+                                         df_res, PATCH_SIZE, soft=args.soft_overlay)
+    if PART is None and args.output_format in ["full", "both"] and \
+        not os.path.exists(paths_output[0]):
+        # Reuse the slide handle opened during tiling for the overlay (opened
+        # for sequential access if tiles were read from a pyramid level)
+        img = None
+        if args.gen_overlay : img = job["reader"].image(access="sequential")
+        res = render_class_map(small_version, PATCH_SIZE, img=img)
+        metrics.vips_progress(slide_name, "tiffsave", res)
+        save_class_map(res, paths_output[0], job["xres"], job["yres"], PATCH_SIZE)
+        del res
+    # Class & probability maps at tile grid resolution
+    if PART is None and args.output_format in ["grid", "both"] and \
+        not all(os.path.exists(p) for p in paths_output[-2:]):
+        probs = probability_reassemble(job["max_X"], job["max_Y"], slide_name,
+                                       df_res, PATCH_SIZE)
+        save_grid_maps(os.path.join(RES_PATH, slide_name + "_gleason"),
+                       small_version, probs, job["xres"], job["yres"], PATCH_SIZE,
+                       (job["max_X"], job["max_Y"]))
+    del job["reader"]
 
     # cleanup
-    for f in os.listdir(patch_path):
-        os.remove(os.path.join(patch_path, f))
-    os.rmdir(patch_path)
-if TEMP_CACHE:
-    os.rmdir(BASE_PATH)
+    patch_path = job["patch_path"]
+    if patch_path is not None:
+        for f in os.listdir(patch_path):
+            os.remove(os.path.join(patch_path, f))
+        os.rmdir(patch_path)
+    # Serve mode never finishes, thus the CSV is refreshed after each slide
+    if args.watch and STORE_PREDICTIONS and PART is None:
+        with export_lock : store.export_csv(PREDICTION_PATH)
+    if work_queue is not None : work_queue.release(slide, "done")
+    print("Finished slide:", slide)
+
+def slide_failed(stage, item, error):
+    # Record failed slides and release their lock for another attempt
+    if work_queue is None : return
+    slide = item if isinstance(item, str) else item["slide"]
+    work_queue.release(slide, "failed",
+                       error=stage + ": " + repr(error))
+
+def watch_slides(path):
+    # Serve mode: poll the input directory and yield new slides as soon as they are complete
+    print("Watching for new slides in:", path)
+    sizes = {}
+    done = set()
+    while True:
+        for f in sorted(os.listdir(path)):
+            slide = os.path.join(path, f)
+            if slide in done or not os.path.isfile(slide) : continue
+            # Skip outputs if the output directory is the watched directory
+            if is_output(f) or \
+                os.path.abspath(slide) == os.path.abspath(PREDICTION_PATH) : continue
+            # Only process slides whose file size is stable (fully copied)
+            size = os.path.getsize(slide)
+            if sizes.get(slide) != size:
+                sizes[slide] = size
+                continue
+            done.add(slide)
+            yield slide
+        time.sleep(args.poll_interval)
+
+#------------------------------------------------------#
+#                      Main Script                     #
+#------------------------------------------------------#
+# Overlap reading of the next slide, inference and writing of the previous slide
+# (inference uses a single worker as the model is shared)
+pipeline = Pipeline([("reader", instrument("tiling", read_slide),
+                      args.workers_reader),
+                     ("inference", instrument("inference", predict_slide), 1),
+                     ("writer", instrument("writing", write_slide),
+                      args.workers_writer)],
+                    queue_size=args.queue_size, on_error=slide_failed)
+if not args.watch:
+    # Slides are claimed one after another if multiple workers share the inputs
+    if work_queue is not None : INPUTS = work_queue.claim(INPUTS)
+    failures = pipeline.run(INPUTS)
+    # Export all predictions of the store as CSV
+    if STORE_PREDICTIONS and PART is None : store.export_csv(PREDICTION_PATH)
+elif work_queue is not None:
+    failures = pipeline.run(work_queue.claim(watch_slides(args.input[0]), sort=False))
+else : failures = pipeline.run(watch_slides(args.input[0]))
+if replica_pool is not None : replica_pool.close()
+# Exit with an error code if any slide failed
+if len(failures) > 0:
+    print("Failed slides:", len(failures))
+    sys.exit(1)
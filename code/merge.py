@@ -0,0 +1,147 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import argparse
+
+from proc import tile_grid, class_reassemble, render_class_map
+from proc import save_class_map, probability_reassemble, save_grid_maps, is_output
+from slide_reader import SlideReader
+from store import PredictionStore
+
+# -----------------------------------------------------#
+#                     CLI Argparser                    #
+# -----------------------------------------------------#
+parser = argparse.ArgumentParser(description="DeepGleason: Merge Shards")
+parser.add_argument(
+    "-i",
+    "--input",
+    help="Path to the input slide or a directory of slides",
+    required=True,
+    type=str,
+    dest="input",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    help="Path where the slides are stored",
+    required=False,
+    type=str,
+    dest="output",
+    default="./",
+)
+parser.add_argument(
+    "--store",
+    help="directory of the prediction store containing the partial shards. " + \
+         "Default: predictions.store in the output directory",
+    dest="store",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--output_format",
+    help="output of each slide: full-resolution class map (full), class & " + \
+         "probability maps at tile grid resolution (grid) or both",
+    dest="output_format",
+    choices=["full", "grid", "both"],
+    default="full",
+    required=False,
+    type=str,
+)
+parser.add_argument(
+    "--generate_overlay",
+    help="merge prediction distribution with base image as overlay",
+    dest="gen_overlay",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "--soft_overlay",
+    help="blend class colors by the predicted probabilities instead of the argmax class",
+    dest="soft_overlay",
+    action="store_true",
+    default=False,
+    required=False,
+)
+parser.add_argument(
+    "-p",
+    "--predictions",
+    help="output CSV containing predicted soft labels of all slides in the " + \
+         "prediction store (exported after merging)",
+    dest="prediction",
+    required=False,
+    type=str,
+)
+args = parser.parse_args()
+
+PATCH_SIZE = (1024, 1024)
+
+INPUTS = [args.input]
+if os.path.isdir(args.input):
+    INPUTS = [os.path.join(args.input, x) for x in sorted(os.listdir(args.input))]
+    INPUTS = [x for x in INPUTS if os.path.isfile(x) and not is_output(x)]
+
+STORE_PATH = args.store
+if STORE_PATH is None : STORE_PATH = os.path.join(args.output, "predictions.store")
+store = PredictionStore(STORE_PATH)
+
+# -----------------------------------------------------#
+#                     Merge Shards                     #
+# -----------------------------------------------------#
+def merge_slide(slide):
+    slide_name = os.path.basename(slide)
+    slide_name = slide_name[: slide_name.find(".")]
+    df_res = store.load_partials(slide_name)
+    if df_res is None : return
+    # All tiles of the grid have to be covered by the shards
+    reader = SlideReader(slide)
+    max_X = reader.width - (reader.width % PATCH_SIZE[0])
+    max_Y = reader.height - (reader.height % PATCH_SIZE[1])
+    tiles = tile_grid(max_X, max_Y, slide_name, PATCH_SIZE)
+    missing = len(set(tiles["sample"]) - set(df_res["sample"]))
+    if missing > 0:
+        print("Skipping slide:", slide, "-", missing, "tiles missing in the shards",
+              store.partials(slide_name))
+        return
+    store.append(slide_name, df_res)
+    # Write class map of the whole slide
+    small_version = class_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE,
+                                     soft=args.soft_overlay)
+    if args.output_format in ["full", "both"]:
+        img = reader.image(access="sequential") if args.gen_overlay else None
+        res = render_class_map(small_version, PATCH_SIZE, img=img)
+        save_class_map(res, os.path.join(args.output, slide_name + "_gleason.tiff"),
+                       reader.xres, reader.yres, PATCH_SIZE)
+    if args.output_format in ["grid", "both"]:
+        probs = probability_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE)
+        save_grid_maps(os.path.join(args.output, slide_name + "_gleason"),
+                       small_version, probs, reader.xres, reader.yres,
+                       PATCH_SIZE, (max_X, max_Y))
+    store.clear_partials(slide_name)
+    print("Merged slide:", slide, "-", len(df_res), "tiles")
+
+# -----------------------------------------------------#
+#                      Main Script                     #
+# -----------------------------------------------------#
+for slide in INPUTS:
+    merge_slide(slide)
+# Export all predictions of the store as CSV
+if args.prediction is not None : store.export_csv(args.prediction)
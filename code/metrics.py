@@ -0,0 +1,158 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import time
+import json
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+# -----------------------------------------------------#
+#                  Process Statistics                  #
+# -----------------------------------------------------#
+def peak_rss():
+    # Peak resident set size of the process in bytes (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def io_bytes():
+    # Bytes read from and written to storage by the process (Linux only)
+    stats = {"read_bytes": 0, "write_bytes": 0}
+    try:
+        with open("/proc/self/io") as reader:
+            for line in reader:
+                key, value = line.split(":")
+                if key in stats : stats[key] = int(value)
+    except OSError:
+        pass
+    return stats
+
+# -----------------------------------------------------#
+#                      Run Metrics                     #
+# -----------------------------------------------------#
+class Metrics:
+    """ Collects machine-readable metrics per slide and pipeline stage.
+
+    Each finished stage is emitted as a JSON line containing wall time, CPU time,
+    tiles/sec, peak RSS and bytes read/written. CPU time and I/O are process-wide
+    counters, thus they include concurrently running stages of other slides.
+    Optionally, the latest values are written as Prometheus text file.
+
+    Args:
+        path (str):             Path of the JSON lines file. If None, metrics are not emitted.
+        path_prometheus (str):  Path of the Prometheus text file. If None, it is not written.
+        profile (str):          Slide name for which cProfile dumps of all stages are stored.
+        profile_tf (bool):      Additionally record a TensorFlow profile of the inference stage.
+        profile_dir (str):      Directory for the profiling dumps.
+    """
+    def __init__(self, path=None, path_prometheus=None, profile=None,
+                 profile_tf=False, profile_dir="."):
+        self.path = path
+        self.path_prometheus = path_prometheus
+        self.profile = profile
+        self.profile_tf = profile_tf
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.latest = {}
+
+    def emit(self, record):
+        record["timestamp"] = time.time()
+        with self.lock:
+            if self.path is not None:
+                with open(self.path, "a") as writer:
+                    writer.write(json.dumps(record) + "\n")
+            if self.path_prometheus is not None and "stage" in record:
+                self.latest[(record["slide"], record["stage"])] = record
+                self.write_prometheus()
+
+    def write_prometheus(self):
+        lines = []
+        for metric in ["wall_seconds", "cpu_seconds", "tiles_per_sec"]:
+            lines.append("# TYPE deepgleason_stage_" + metric + " gauge")
+            for (slide, stage), record in sorted(self.latest.items()):
+                if record.get(metric) is None : continue
+                lines.append('deepgleason_stage_%s{slide="%s",stage="%s"} %s' % \
+                             (metric, slide, stage, record[metric]))
+        lines.append("# TYPE deepgleason_peak_rss_bytes gauge")
+        lines.append("deepgleason_peak_rss_bytes %d" % peak_rss())
+        io = io_bytes()
+        for key in ["read_bytes", "write_bytes"]:
+            lines.append("# TYPE deepgleason_" + key + "_total counter")
+            lines.append("deepgleason_%s_total %d" % (key, io[key]))
+        # Replace atomically for scrapers reading the file concurrently
+        path_tmp = self.path_prometheus + ".tmp"
+        with open(path_tmp, "w") as writer:
+            writer.write("\n".join(lines) + "\n")
+        os.replace(path_tmp, self.path_prometheus)
+
+    @contextmanager
+    def stage(self, slide_name, stage):
+        """ Measure a pipeline stage of a slide.
+
+        The yielded dictionary can be filled with additional fields; the field
+        "tiles" is used to compute the throughput of the stage.
+        """
+        record = {"slide": slide_name, "stage": stage}
+        io_start = io_bytes()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        profiler = None
+        if self.profile == slide_name:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if self.profile == slide_name and self.profile_tf and stage == "inference":
+            import tensorflow as tf
+            tf.profiler.experimental.start(os.path.join(self.profile_dir,
+                                                        slide_name + ".tf"))
+        try:
+            yield record
+        finally:
+            if self.profile == slide_name and self.profile_tf and \
+                stage == "inference":
+                import tensorflow as tf
+                tf.profiler.experimental.stop()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir,
+                                                 slide_name + "." + stage + ".prof"))
+            record["wall_seconds"] = time.perf_counter() - wall_start
+            record["cpu_seconds"] = time.process_time() - cpu_start
+            if record.get("tiles") is not None:
+                record["tiles_per_sec"] = record["tiles"] / \
+                                          max(record["wall_seconds"], 1e-9)
+            record["peak_rss_bytes"] = peak_rss()
+            io_end = io_bytes()
+            for key in io_end:
+                record[key] = io_end[key] - io_start[key]
+            self.emit(record)
+
+    def vips_progress(self, slide_name, stage, image, step=10):
+        """ Emit libvips evaluation progress of an image via its eval signal. """
+        state = {"next": step}
+        def eval_handler(image, progress):
+            if progress.percent < state["next"] : return
+            state["next"] = progress.percent + step
+            self.emit({"slide": slide_name, "event": stage + "_progress",
+                       "percent": progress.percent, "run": progress.run,
+                       "eta": progress.eta, "npels": progress.npels,
+                       "tpels": progress.tpels})
+        image.set_progress(True)
+        image.signal_connect("eval", eval_handler)
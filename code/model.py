@@ -18,47 +18,267 @@
 # -----------------------------------------------------#
 #                    Library imports                   #
 # -----------------------------------------------------#
+import numpy as np
 import pandas as pd
 import tensorflow as tf
 from PIL import Image
 import os
+from concurrent.futures import ThreadPoolExecutor
 # AUCMEDI libraries
 from aucmedi import DataGenerator, NeuralNetwork
-from aucmedi.data_processing.subfunctions import Padding
+from aucmedi.neural_network.architectures import supported_standardize_mode
+from aucmedi.data_processing.subfunctions import Padding, Resize, Standardize
 from stain_normalization import StainNormalization
+from proc import tile_loader, COL_NAMES
+from tile_cache import cache_loader
 
 # -----------------------------------------------------#
 #                   AUCMEDI Pipeline                   #
 # -----------------------------------------------------#
-COL_NAMES = ["A_S", "A_D", "R", "G3", "G4", "G5"]
+def background_predictions(x):
+    # Tiles without tissue are directly assigned to the Artefact Empty class
+    df = pd.DataFrame(0.0, index=range(len(x)), columns=COL_NAMES)
+    df["A_D"] = 1.0
+    df["sample"] = list(x)
+    df["class"] = "A_D"
+    df["model"] = "prefilter"
+    return df
+
+class BatchModel:
+    """ Base of inference backends predicting preprocessed batches via predict_batch.
+
+    Provides the subset of the AUCMEDI NeuralNetwork interface used by run_aucmedi.
+    """
+    def predict(self, gen):
+        preds = []
+        for i in range(len(gen)):
+            batch = gen[i]
+            if isinstance(batch, tuple) : batch = batch[0]
+            preds.append(self.predict_batch(batch))
+        return np.concatenate(preds, axis=0)
+
+class TFLiteModel(BatchModel):
+    """ Inference backend for TFLite models exported via export.py.
+
+    The architecture is identified from the file name (model.<architecture>.<mode>.tflite).
+
+    Args:
+        path (str):             Path to the TFLite model.
+        num_threads (int):      Number of threads of the TFLite interpreter.
+    """
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path,
+                                               num_threads=num_threads)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.arch_name = os.path.basename(path).split(".")[1]
+        self.meta_input = tuple(self.input_details["shape"][1:3])
+        self.meta_standardize = supported_standardize_mode["2D." + self.arch_name]
+        self.multiprocessing = False
+
+    def predict_batch(self, batch):
+        # Quantize input if the model expects integer input
+        scale, zero_point = self.input_details["quantization"]
+        if self.input_details["dtype"] != np.float32 and scale > 0:
+            batch = np.round(batch / scale + zero_point)
+        batch = batch.astype(self.input_details["dtype"])
+        # Adapt interpreter to batch size
+        self.interpreter.resize_tensor_input(self.input_details["index"],
+                                             batch.shape)
+        self.interpreter.allocate_tensors()
+        self.interpreter.set_tensor(self.input_details["index"], batch)
+        self.interpreter.invoke()
+        preds = self.interpreter.get_tensor(self.output_details["index"])
+        # Dequantize output
+        scale, zero_point = self.output_details["quantization"]
+        if self.output_details["dtype"] != np.float32 and scale > 0:
+            preds = (preds.astype(np.float32) - zero_point) * scale
+        return preds.astype(np.float32)
+
+class SnapshotModel(BatchModel):
+    """ Inference backend for pre-traced model snapshots exported via export.py.
 
-def run_aucmedi(x, architecture, config):
-    # Load stain normalization
+    Snapshots are SavedModels containing the traced inference graph, thus neither
+    the architecture has to be built nor the weights loaded into it.
+    The architecture is identified from the name (model.<architecture>.savedmodel).
+
+    Args:
+        path (str):             Path to the snapshot directory.
+    """
+    def __init__(self, path):
+        self.snapshot = tf.saved_model.load(path)
+        self.infer = self.snapshot.signatures["serving_default"]
+        self.arch_name = os.path.basename(os.path.normpath(path)).split(".")[1]
+        spec = list(self.infer.structured_input_signature[1].values())[0]
+        self.meta_input = tuple(spec.shape[1:3])
+        self.meta_standardize = supported_standardize_mode["2D." + self.arch_name]
+        self.multiprocessing = False
+
+    def predict_batch(self, batch):
+        preds = self.infer(tf.convert_to_tensor(batch, dtype=tf.float32))
+        return np.asarray(preds["output"], dtype=np.float32)
+
+def export_snapshot(model, path):
+    # Trace the Keras model once for its input resolution and store it as SavedModel
+    spec = tf.TensorSpec([None, model.meta_input[1], model.meta_input[0], 3],
+                         tf.float32, name="input")
+    module = tf.Module()
+    module.model = model.model
+    @tf.function(input_signature=[spec])
+    def serve(batch):
+        return {"output": module.model(batch, training=False)}
+    tf.saved_model.save(module, path, signatures={"serving_default": serve})
+
+def predict_batch(model, batch):
+    # Predict a preprocessed batch with a Keras, TFLite or snapshot model
+    if isinstance(model, BatchModel) : return model.predict_batch(batch)
+    return np.asarray(model.model.predict_on_batch(batch), dtype=np.float32)
+
+# -----------------------------------------------------#
+#                   Ensemble Inference                 #
+# -----------------------------------------------------#
+def aggregate_predictions(preds, method="mean", weights=None):
+    """ Aggregate the soft labels of multiple models.
+
+    Args:
+        preds (numpy.ndarray):  Predictions with shape (n_models, n_samples, n_classes).
+        method (str):           "mean", "weighted" (weighted mean) or "majority"
+                                (fraction of model votes for each class).
+        weights (list):         Model weights for the weighted mean.
+
+    Returns:
+        preds (numpy.ndarray):  Aggregated predictions with shape (n_samples, n_classes).
+    """
+    if method == "weighted":
+        weights = np.asarray(weights, dtype=np.float32)
+        return np.tensordot(weights / weights.sum(), preds, axes=1)
+    elif method == "majority":
+        votes = np.argmax(preds, axis=-1)
+        return np.stack([(votes == c).mean(axis=0) for c in range(preds.shape[-1])],
+                        axis=-1).astype(np.float32)
+    return preds.mean(axis=0)
+
+class Ensemble:
+    """ Ensemble of models sharing the decoding and preprocessing of each batch.
+
+    Tiles are padded, resized and stain normalized once, afterwards every model
+    applies its own standardization and predicts the batch. The soft labels of
+    the models are aggregated in memory and kept in `model_preds` for the last call.
+
+    Args:
+        models (list):          Models as returned by load_model with the same input resolution.
+        aggregate (str):        Aggregation method as in aggregate_predictions.
+        weights (list):         Model weights for the weighted aggregation.
+    """
+    def __init__(self, models, aggregate="mean", weights=None):
+        if len(set(tuple(m.meta_input) for m in models)) > 1:
+            raise ValueError("Models of an ensemble require the same input resolution")
+        if aggregate == "weighted" and (weights is None or \
+                                        len(weights) != len(models)):
+            raise ValueError("Weighted aggregation requires one weight per model")
+        self.models = models
+        self.aggregate = aggregate
+        self.weights = weights
+        self.arch_names = [m.arch_name for m in models]
+        self.arch_name = "+".join(self.arch_names)
+        self.meta_input = models[0].meta_input
+        # Standardization is model specific and thus applied per model
+        self.meta_standardize = None
+        self.standardize = [Standardize(mode=m.meta_standardize) for m in models]
+        self.stain_normalization = models[0].stain_normalization
+        self.multiprocessing = False
+        self.model_preds = None
+
+    def predict(self, gen):
+        preds = [[] for m in self.models]
+        for i in range(len(gen)):
+            batch = gen[i]
+            if isinstance(batch, tuple) : batch = batch[0]
+            for j, m in enumerate(self.models):
+                batch_model = np.stack([self.standardize[j].transform(img) \
+                                        for img in batch], axis=0)
+                preds[j].append(predict_batch(m, batch_model))
+        self.model_preds = np.stack([np.concatenate(p, axis=0) for p in preds])
+        return aggregate_predictions(self.model_preds, self.aggregate, self.weights)
+
+    def predict_dataset(self, ds):
+        self.model_preds = predict_dataset(ds, self.models)
+        return aggregate_predictions(self.model_preds, self.aggregate, self.weights)
+
+def configure_threads(intra_op=None, inter_op=None):
+    # Thread pools of TensorFlow can only be configured before their first use
+    if intra_op is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+def load_model(architecture, nclasses, backend="keras", num_threads=None,
+               load_weights=True, workers=16):
+    if backend == "tflite":
+        model = TFLiteModel(architecture, num_threads=num_threads)
+    elif backend == "snapshot":
+        model = SnapshotModel(architecture)
+    else:
+        # identify architecture
+        arch_name = architecture.split(".")[-2]
+
+        # Initialize model
+        model = NeuralNetwork(
+            nclasses,
+            channels=3,
+            architecture="2D." + arch_name,
+            workers=workers,
+            multiprocessing=True,
+        )
+
+        # Load model (random weights are only used for benchmarking)
+        if load_weights : model.model.load_weights(architecture)
+        model.arch_name = arch_name
+
+    # Load stain normalization once for all slides
     dir_path = os.path.dirname(os.path.realpath(__file__))
     path_stain_target = os.path.join(dir_path, "stainnormalize_target.png")
-    target_image = Image.open(path_stain_target)
+    model.stain_normalization = StainNormalization(Image.open(path_stain_target))
+    return model
+
+def build_subfunctions(model, config):
+    # Stain normalization runs at model input resolution unless requested otherwise
+    if config.get("stain_full_resolution", False):
+        return [Padding(mode="square"), model.stain_normalization]
+    return [Padding(mode="square"), Resize(shape=model.meta_input),
+            model.stain_normalization]
+
+def build_generator(x, model, config):
     # Define Subfunctions
-    sf_list = [Padding(mode="square"), StainNormalization(target_image)]
-
-    # identify architecture
-    arch_name = architecture.split(".")[-2]
-
-    # Initialize model
-    model = NeuralNetwork(
-        config["nclasses"],
-        channels=3,
-        architecture="2D." + arch_name,
-        workers=16, 
-        multiprocessing=True,
-    )
+    sf_list = build_subfunctions(model, config)
 
-    # Load model
-    model.model.load_weights(architecture)
+    # Tiles are fetched in-memory from the slide if no tile directory is used
+    in_memory = config.get("slide_image") is not None
+    loader_args = {}
+    if config.get("cache_tiles") is not None:
+        # Tiles of the tile cache are already preprocessed
+        sf_list = []
+        loader_args = {
+            "loader": cache_loader,
+            "cache_tiles": config["cache_tiles"],
+            "cache_index": config["cache_index"],
+        }
+        in_memory = True
+    elif in_memory:
+        tiles = config["tiles"]
+        loader_args = {
+            "loader": tile_loader,
+            "slide_img": config["slide_image"],
+            "tile_index": dict(zip(tiles["sample"], zip(tiles["x"], tiles["y"]))),
+            "patch_size": config["patch_size"],
+        }
+    # pyvips handles are not fork-safe, thus threads are used for in-memory tiles
+    model.multiprocessing = not in_memory
 
     # Initialize Data Generator
     gen = DataGenerator(
         x,
-        config["path_images"],
+        config.get("path_images"),
         img_aug=None,
         shuffle=False,
         subfunctions=sf_list,
@@ -68,19 +288,217 @@ def run_aucmedi(x, architecture, config):
         prepare_images=False,
         sample_weights=None,
         seed=123,
-        image_format=config["image_format"],
-        workers=6,
+        image_format=config.get("image_format"),
+        batch_size=config.get("batch_size", 32),
+        workers=config.get("workers", 6),
+        **loader_args,
     )
+    return gen
+
+# -----------------------------------------------------#
+#                 tf.data Input Pipeline               #
+# -----------------------------------------------------#
+def build_dataset(x, model, config):
+    """ Build a tf.data input pipeline as alternative to the AUCMEDI DataGenerator.
+
+    Tiles are loaded, resized and stain normalized in parallel with autotuned
+    parallelism and prefetched. Batches stay uint8 until the model specific
+    standardization (see standardize_batch), which is applied on the device.
+
+    Args:
+        x (list):                   Sample names of the tiles.
+        model (NeuralNetwork):      Model defining input resolution & stain normalization.
+        config (dict):              Configuration as for run_aucmedi.
+
+    Returns:
+        ds (tf.data.Dataset):       Dataset of uint8 batches with shape (n, height, width, 3).
+    """
+    AUTOTUNE = tf.data.AUTOTUNE
+    stain = model.stain_normalization
+    stain_full = config.get("stain_full_resolution", False)
+    preprocessed = config.get("cache_tiles") is not None
+
+    def stain_tile(img):
+        return stain.transform_batch(img[None])[0]
+
+    # Load tiles in-memory from slide or tile cache
+    if preprocessed or config.get("slide_image") is not None:
+        if preprocessed:
+            def load(i):
+                return np.asarray(config["cache_tiles"][config["cache_index"][x[i]]])
+        else:
+            tiles = config["tiles"]
+            tile_index = dict(zip(tiles["sample"], zip(tiles["x"], tiles["y"])))
+            def load(i):
+                return tile_loader(x[i], None, slide_img=config["slide_image"],
+                                   tile_index=tile_index,
+                                   patch_size=config["patch_size"])
+        def load_tile(i):
+            img = tf.numpy_function(load, [i], tf.uint8)
+            img.set_shape([None, None, 3])
+            return img
+        ds = tf.data.Dataset.from_tensor_slices(np.arange(len(x)))
+    # Load tiles from tile directory
+    else:
+        paths = [os.path.join(config["path_images"],
+                              s + "." + config["image_format"]) for s in x]
+        def load_tile(path):
+            img = tf.io.decode_image(tf.io.read_file(path), channels=3,
+                                     expand_animations=False)
+            img.set_shape([None, None, 3])
+            return img
+        ds = tf.data.Dataset.from_tensor_slices(paths)
+
+    def preprocess(img):
+        if stain_full:
+            img = tf.numpy_function(stain_tile, [img], tf.uint8)
+            img.set_shape([None, None, 3])
+        # Square padding and resizing to model input
+        img = tf.image.resize_with_pad(img, model.meta_input[1], model.meta_input[0])
+        return tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8)
+
+    def stain_batch(batch):
+        batch = tf.numpy_function(stain.transform_batch, [batch], tf.uint8)
+        batch.set_shape([None, model.meta_input[1], model.meta_input[0], 3])
+        return batch
+
+    ds = ds.map(load_tile, num_parallel_calls=AUTOTUNE)
+    if not preprocessed : ds = ds.map(preprocess, num_parallel_calls=AUTOTUNE)
+    ds = ds.batch(config.get("batch_size", 32))
+    if not preprocessed and not stain_full:
+        ds = ds.map(stain_batch, num_parallel_calls=AUTOTUNE)
+    ds = ds.prefetch(AUTOTUNE)
+    if len(tf.config.list_logical_devices("GPU")) > 0:
+        ds = ds.apply(tf.data.experimental.prefetch_to_device("/gpu:0"))
+    return ds
+
+def standardize_batch(batch, mode):
+    # Standardization of an uint8 batch as last step (on the device if possible)
+    if mode in ["tf", "caffe", "torch"]:
+        batch = tf.cast(batch, tf.float32)
+        return tf.keras.applications.imagenet_utils.preprocess_input(batch, mode=mode)
+    sf = Standardize(mode=mode)
+    batch = np.asarray(batch)
+    return np.stack([sf.transform(img) for img in batch], axis=0).astype(np.float32)
+
+def predict_dataset(ds, models):
+    # Predict all batches of a dataset with one or multiple models
+    preds = [[] for m in models]
+    for batch in ds:
+        for j, m in enumerate(models):
+            batch_model = standardize_batch(batch, m.meta_standardize)
+            if isinstance(m, TFLiteModel) : batch_model = np.asarray(batch_model)
+            preds[j].append(predict_batch(m, batch_model))
+    if len(preds[0]) == 0:
+        return np.zeros((len(models), 0, len(COL_NAMES)), dtype=np.float32)
+    return np.stack([np.concatenate(p, axis=0) for p in preds])
 
+def cache_tiles(tiles, model, config, cache, slide_name, settings=None,
+                chunk_size=256, workers=6):
+    """ Preprocess tiles once and store them in the tile cache.
+
+    Tiles are read in-memory from the slide (config as for run_aucmedi), padded,
+    resized to the model input and stain normalized.
+
+    Args:
+        tiles (pandas.DataFrame):   Tiles with columns sample, x and y.
+        model (NeuralNetwork):      Model defining input resolution & stain normalization.
+        config (dict):              Configuration with slide_image, tiles and patch_size.
+        cache (TileCache):          Tile cache.
+        slide_name (str):           Name of the slide.
+        settings (dict):            Preprocessing settings stored with the cache entry.
+        chunk_size (int):           Number of tiles preprocessed & written at once.
+        workers (int):              Number of threads reading & preprocessing tiles.
+    """
+    sf_list = build_subfunctions(model, config) + [Resize(shape=model.meta_input)]
+    tile_index = dict(zip(tiles["sample"], zip(tiles["x"], tiles["y"])))
+
+    def preprocess(sample):
+        img = tile_loader(sample, None, slide_img=config["slide_image"],
+                          tile_index=tile_index, patch_size=config["patch_size"])
+        for sf in sf_list:
+            img = sf.transform(img)
+        return img.astype(np.uint8)
+
+    def chunks(pool):
+        samples = list(tiles["sample"])
+        for i in range(0, len(samples), chunk_size):
+            yield np.stack(list(pool.map(preprocess, samples[i:i+chunk_size])))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        cache.write(slide_name, model.meta_input, tiles, chunks(pool), settings)
+
+def run_aucmedi(x, model, config):
     # generate predictions
-    preds = model.predict(gen)
+    if config.get("input_pipeline") == "tfdata":
+        gen = build_dataset(x, model, config)
+        if isinstance(model, Ensemble) : preds = model.predict_dataset(gen)
+        else : preds = predict_dataset(gen, [model])[0]
+    else:
+        gen = build_generator(x, model, config)
+        preds = model.predict(gen)
     # create dataframe from predictions. Order is relevant here ans is the same as training.
     df = pd.DataFrame(preds, columns=COL_NAMES)
     df["sample"] = x
     df["class"] = df[COL_NAMES].idxmax(axis=1)
-    # Garbage collection
+    df["model"] = model.arch_name
+    # Keep soft labels of each ensemble member (columns "<class>.<architecture>")
+    if isinstance(model, Ensemble):
+        for preds_model, arch_name in zip(model.model_preds, model.arch_names):
+            for i, c in enumerate(COL_NAMES):
+                df[c + "." + arch_name] = preds_model[:, i]
+    # Garbage collection (model is kept resident for further slides)
     del gen
-    del model
     del preds
-    tf.keras.backend.clear_session()
     return df
+
+# -----------------------------------------------------#
+#                   Cascade Inference                  #
+# -----------------------------------------------------#
+def run_cascade(x, model_screen, model, config, threshold=0.9, criterion="maxprob"):
+    """ Screen all tiles with a fast model and re-score uncertain tiles with the main model.
+
+    Tiles are re-scored if their confidence is below the threshold or if they are
+    predicted as a Gleason class by the screening model. The column "model" records
+    which model decided each tile and the column "rescored" whether a tile has been
+    re-scored by the main model (also if both models share an architecture).
+
+    Args:
+        x (list):                       Sample names of the tiles.
+        model_screen (NeuralNetwork):   Fast screening model (e.g. DenseNet121).
+        model (NeuralNetwork):          Main model (e.g. ConvNeXtBase).
+        config (dict):                  Configuration as for run_aucmedi.
+        threshold (float):              Confidence threshold for accepting a screening prediction.
+        criterion (str):                Confidence measure: "maxprob" (maximum softmax) or
+                                        "margin" (difference between the two highest probabilities).
+
+    Returns:
+        df (pandas.DataFrame):          Predictions as returned by run_aucmedi.
+    """
+    df = run_aucmedi(x, model_screen, config)
+    probs = np.sort(df[COL_NAMES].to_numpy(), axis=1)
+    if criterion == "margin" : confidence = probs[:, -1] - probs[:, -2]
+    else : confidence = probs[:, -1]
+    uncertain = (confidence < threshold) | df["class"].isin(["G3", "G4", "G5"])
+    df["rescored"] = uncertain.to_numpy()
+    # Re-score uncertain tiles with the main model
+    if uncertain.any():
+        df_main = run_aucmedi(list(df.loc[uncertain, "sample"]), model, config)
+        cols = COL_NAMES + ["class", "model"]
+        df.loc[uncertain, cols] = df_main[cols].to_numpy()
+        df[COL_NAMES] = df[COL_NAMES].astype(np.float32)
+    return df
+
+def cascade_report(df_cascade, df_full, time_cascade, time_full):
+    # Compare a cascade run with a full run of the main model on the same tiles
+    df = df_cascade.merge(df_full, on="sample", suffixes=("_cascade", "_full"))
+    agree = df["class_cascade"] == df["class_full"]
+    report = {
+        "tiles": len(df),
+        "rescored": float(df["rescored"].eq(True).mean()),
+        "speedup": time_full / max(time_cascade, 1e-9),
+        "agreement": float(agree.mean()),
+        "agreement_per_class": {c: float(agree[df["class_full"] == c].mean()) \
+                                for c in COL_NAMES if (df["class_full"] == c).any()},
+    }
+    return report
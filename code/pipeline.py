@@ -0,0 +1,102 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import queue
+import threading
+import traceback
+
+# -----------------------------------------------------#
+#                Staged Slide Pipeline                 #
+# -----------------------------------------------------#
+class Pipeline:
+    """ Runs items through a sequence of stages which are executed concurrently.
+
+    Each stage is a function processing a single item and returning the item for
+    the next stage (or None to drop it). Stages are connected by bounded queues,
+    so that a slow stage blocks its predecessors (backpressure) and the number of
+    slides held in memory stays limited.
+
+    Args:
+        stages (list):          List of (name, function, n_workers) tuples.
+        queue_size (int):       Maximum number of items waiting between two stages.
+        on_error (function):    Optional callback (stage name, item, exception) for
+                                items dropped due to an exception in a stage.
+
+    `run` returns the failures of all stages as list of (stage name, item, exception).
+    """
+    def __init__(self, stages, queue_size=1, on_error=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        failures = []
+        for i, (name, func, n_workers) in enumerate(self.stages):
+            out_queue = queues[i+1] if i+1 < len(queues) else None
+            n_next = self.stages[i+1][2] if i+1 < len(self.stages) else 0
+            counter = {"running": n_workers}
+            lock = threading.Lock()
+            for w in range(n_workers):
+                t = threading.Thread(target=self._worker, name=name + "-" + str(w),
+                                     args=(name, func, queues[i], out_queue,
+                                           n_next, counter, lock, self.on_error,
+                                           failures),
+                                     daemon=True)
+                t.start()
+                threads.append(t)
+        # Feed items into the first stage
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            queues[0].put(None)
+        for t in threads:
+            t.join()
+        return failures
+
+    @staticmethod
+    def _worker(name, func, in_queue, out_queue, n_next, counter, lock, on_error,
+                failures):
+        while True:
+            item = in_queue.get()
+            if item is None : break
+            try:
+                res = func(item)
+            except Exception as e:
+                print("Pipeline stage '" + name + "' failed:")
+                traceback.print_exc()
+                failures.append((name, item, e))
+                # A failing callback must not stop the worker (end of queue signal)
+                if on_error is not None:
+                    try : on_error(name, item, e)
+                    except Exception:
+                        print("Pipeline error callback of stage '" + name + "' failed:")
+                        traceback.print_exc()
+                res = None
+            if res is not None and out_queue is not None:
+                out_queue.put(res)
+        # Last finishing worker of this stage signals the end to the next stage
+        with lock:
+            counter["running"] -= 1
+            last = counter["running"] == 0
+        if last and out_queue is not None:
+            for _ in range(n_next):
+                out_queue.put(None)
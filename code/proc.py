@@ -19,94 +19,320 @@
 #                    Library imports                   #
 # -----------------------------------------------------#
 import os
+import json
 import pyvips
 
+from slide_reader import open_slide
+
 os.environ["VIPS_CONCURRENCY"] = "0"
 import numpy as np
 import pandas as pd
-import math
-from tqdm import tqdm
+
+#------------------------------------------------------#
+#                   Class Definitions                  #
+#------------------------------------------------------#
+# Order is relevant here and is the same as training.
+COL_NAMES = ["A_S", "A_D", "R", "G3", "G4", "G5"]
+# Colors of the classes in the reassembled class map (same order as COL_NAMES)
+PALETTE = np.array([[76, 76, 76],       # Gray
+                    [0, 0, 0],          # Black
+                    [0, 255, 0],        # Green
+                    [255, 255, 0],      # Yellow
+                    [255, 127, 0],      # Orange
+                    [255, 0, 0]],       # Red
+                   dtype=np.uint8)
 
 #------------------------------------------------------#
 #             Processing Utility Functions             #
 #------------------------------------------------------#
-def eval_handler(image, progress):
-    print('run time so far (secs) = {}'.format(progress.run))
-    print('estimated time of arrival (secs) = {}'.format(progress.eta))
-    print('total number of pels to process = {}'.format(progress.tpels))
-    print('number of pels processed so far = {}'.format(progress.npels))
-    print('percent complete = {}'.format(progress.percent))
-
-def gen_tiles(patch_path, slide, name, PATCH_SIZE):
-    props = {
-        "compression": "jpeg",
-        "xres": 4000,
-        "yres": 4000,
-        "tile": True,
-        "tile_width": PATCH_SIZE[0],
-        "tile_height": PATCH_SIZE[1],
-        "pyramid": True,
-        "bigtiff": True,
-    }
-    img_r = pyvips.Image.new_from_file(slide, page=0)
-    img_g = pyvips.Image.new_from_file(slide, page=1)
-    img_b = pyvips.Image.new_from_file(slide, page=2)
+def tile_grid(width, height, name, PATCH_SIZE):
+    # Enumerate all full tiles of the slide together with their grid position
+    xs, ys = np.meshgrid(np.arange(width // PATCH_SIZE[0]),
+                         np.arange(height // PATCH_SIZE[1]), indexing="ij")
+    xs = xs.ravel()
+    ys = ys.ravel()
+    samples = [name + "_%06d_%06d" % ((x + 1) * PATCH_SIZE[0],
+                                      (y + 1) * PATCH_SIZE[1])
+               for x, y in zip(xs, ys)]
+    return pd.DataFrame({"sample": samples, "x": xs, "y": ys})
+
+def select_tiles(tiles, shard=None, tile_range=None):
+    """ Select the tiles of a shard of the tile grid.
 
-    img = img_r.bandjoin([img_g, img_b])
-    img = img.copy(interpretation="rgb")
+    Args:
+        tiles (pandas.DataFrame):   Tile grid as returned by tile_grid.
+        shard (tuple):              (index, count): band of grid rows (y) of the shard.
+        tile_range (tuple):         (start, end): explicit range of tiles in grid order.
+    """
+    if shard is not None and len(tiles) > 0:
+        index, count = shard
+        rows = np.array_split(np.arange(tiles["y"].max() + 1), count)[index]
+        tiles = tiles[tiles["y"].isin(rows)]
+    if tile_range is not None:
+        tiles = tiles.iloc[tile_range[0]:tile_range[1]]
+    return tiles.reset_index(drop=True)
 
-    #img.set_progress(True)
-    #img.signal_connect("eval", eval_handler)
+def otsu_threshold(values):
+    # Otsu's method on a uint8 histogram: maximize between-class variance
+    hist = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    bins = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    mean_bg = np.cumsum(hist * bins) / np.maximum(weight_bg, 1)
+    mean_fg = ((hist * bins).sum() - np.cumsum(hist * bins)) / np.maximum(weight_fg, 1)
+    variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(variance))
 
-    width = img.width
-    height = img.height
+def tissue_mask(slide, width, height, PATCH_SIZE, threshold=0.05,
+                resolution=16, min_saturation=20):
+    """ Estimate which tiles of the grid contain tissue based on a thumbnail of the slide.
+
+    The thumbnail is generated via libvips, which uses a lower pyramid level if available.
+    Tissue is detected by Otsu thresholding on the saturation channel, because
+    stained tissue is colorful whereas glass background is gray/white.
+
+    Args:
+        slide (str):                Path to the slide or opened SlideReader.
+        width (int):                Width of the tile grid in pixels (as returned by gen_tiles).
+        height (int):               Height of the tile grid in pixels (as returned by gen_tiles).
+        PATCH_SIZE (tuple):         Tile size in pixels.
+        threshold (float):          Minimum fraction of tissue pixels for a tile to count as tissue.
+        resolution (int):           Thumbnail pixels per tile edge.
+        min_saturation (int):       Lower bound for the saturation threshold (0-255).
+
+    Returns:
+        mask (numpy.ndarray):       Boolean array with shape (n_tiles_x, n_tiles_y).
+    """
+    # Load thumbnail from the closest pyramid level of the slide
+    reader = open_slide(slide)
+    thumb_width = max(1, round(reader.width * resolution / PATCH_SIZE[0]))
+    thumb_height = max(1, round(reader.height * resolution / PATCH_SIZE[1]))
+    thumb = reader.thumbnail(thumb_width, thumb_height)
+    thumb = np.ndarray(buffer=thumb.write_to_memory(), dtype=np.uint8,
+                       shape=(thumb.height, thumb.width, thumb.bands))
+    # Compute saturation based tissue mask
+    thumb = thumb.astype(np.int16)
+    c_max = thumb.max(axis=-1)
+    c_min = thumb.min(axis=-1)
+    saturation = ((c_max - c_min) * 255 // np.maximum(c_max, 1)).astype(np.uint8)
+    level = max(otsu_threshold(saturation), min_saturation)
+    pixel_mask = saturation > level
+    # Aggregate tissue fraction per tile
+    nx = width // PATCH_SIZE[0]
+    ny = height // PATCH_SIZE[1]
+    pixel_mask = pixel_mask[:ny * resolution, :nx * resolution]
+    pad_y = ny * resolution - pixel_mask.shape[0]
+    pad_x = nx * resolution - pixel_mask.shape[1]
+    pixel_mask = np.pad(pixel_mask, ((0, pad_y), (0, pad_x)))
+    fraction = pixel_mask.reshape(ny, resolution, nx, resolution).mean(axis=(1, 3))
+    return fraction.T >= threshold
+
+def gen_tiles(patch_path, slide, name, PATCH_SIZE, tissue_threshold=None,
+              downsample=1, shard=None, tile_range=None):
+    # Slide is opened once, all stages share the handle of the SlideReader
+    reader = open_slide(slide)
+
+    width = reader.width
+    height = reader.height
     width = width - (width % PATCH_SIZE[0])
     height = height - (height % PATCH_SIZE[1])
+    xres, yres = reader.xres, reader.yres
+
+    tiles = tile_grid(width, height, name, PATCH_SIZE)
+    # Restrict to a shard of the slide if processed by multiple processes
+    if shard is not None or tile_range is not None:
+        tiles = select_tiles(tiles, shard, tile_range)
 
-    for px in range(0, width, PATCH_SIZE[0]):
-        for py in range(0, height, PATCH_SIZE[1]):
-            sample = name + "_%06d_%06d" % (px + PATCH_SIZE[0], py + PATCH_SIZE[1])
+    # Identify background tiles which do not have to be passed to the model
+    if tissue_threshold is not None:
+        mask = tissue_mask(reader, width, height, PATCH_SIZE, tissue_threshold)
+        tiles["tissue"] = mask[tiles["x"], tiles["y"]]
+    else:
+        tiles["tissue"] = True
 
+    # Read tiles from a pyramid level closer to the model input resolution
+    img, factor = reader.level(downsample)
+    read_size = (PATCH_SIZE[0] // factor, PATCH_SIZE[1] // factor)
+
+    # Tiles are only written to disk if a cache directory is provided,
+    # otherwise they are fetched in-memory via tile_loader during inference
+    if patch_path is not None:
+        tissue = tiles[tiles["tissue"]]
+        for sample, x, y in zip(tissue["sample"], tissue["x"], tissue["y"]):
             location = os.path.join(patch_path, sample + ".png")
 
             if os.path.exists(location):
                 continue
             # generate and store patch
-            crp = img.crop(px, py, PATCH_SIZE[0], PATCH_SIZE[1])
+            crp = img.crop(x * read_size[0], y * read_size[1],
+                           read_size[0], read_size[1])
             crp.write_to_file(location)
-    return (width, height, img.get("xres"), img.get("yres"))
-
-
-def class_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE):
-    cntr = tqdm(
-        total=math.ceil(max_X / PATCH_SIZE[0]) * math.ceil(max_Y / PATCH_SIZE[1])
-    )
-    small_version = np.zeros((max_X // PATCH_SIZE[0], max_Y // PATCH_SIZE[1], 3))
-    for x, px in enumerate(range(PATCH_SIZE[0], max_X, PATCH_SIZE[0])):
-        for y, py in enumerate(range(PATCH_SIZE[1], max_Y, PATCH_SIZE[1])):
-            file_name = slide_name + "_%06d_%06d" % (px, py)
-
-            samp = df_res.at[
-                file_name, "class"
-            ]  # May lead to interesting behavior, if names are non unique
-            if isinstance(samp, pd.Series): samp = str(samp[0])
-            if samp == "A_S":
-                small_version[x, y] = [0.3, 0.3, 0.3]
-            if samp == "A_D":
-                small_version[x, y] = [0, 0, 0]  # White
-            elif samp == "R":
-                small_version[x, y] = [0, 1, 0]  # Green
-            elif samp == "G3":
-                small_version[x, y] = [1, 1, 0]     # Yellow
-            elif samp == "G4":
-                small_version[x, y] = [1, 0.5, 0]   # Orange
-            elif samp == "G5":
-                small_version[x, y] = [1, 0, 0]     # Red
-
-            cntr.update(1)
-    del cntr
-
-    small_version *= 255
-    small_version = small_version.astype(np.uint8)
+    return (img, tiles, width, height, xres, yres, read_size)
+
+def tile_loader(sample, path_imagedir, image_format=None, grayscale=False,
+                slide_img=None, tile_index=None, patch_size=None, **kwargs):
+    """ AUCMEDI loader which fetches a tile directly from an opened pyvips
+        image instead of decoding a stored PNG file.
+
+    Args:
+        sample (str):               Tile name as produced by tile_grid.
+        path_imagedir (str):        Unused, required by the AUCMEDI loader interface.
+        slide_img (pyvips.Image):   Opened slide as returned by SlideReader.image or SlideReader.level.
+        tile_index (dict):          Mapping of tile names to their (x, y) grid position.
+        patch_size (tuple):         Tile size in pixels at the resolution of slide_img.
+
+    Returns:
+        img (numpy.ndarray):        Tile as uint8 NumPy array with shape (height, width, 3).
+    """
+    x, y = tile_index[sample]
+    region = pyvips.Region.new(slide_img)
+    data = region.fetch(x * patch_size[0], y * patch_size[1],
+                        patch_size[0], patch_size[1])
+    img = np.frombuffer(data, dtype=np.uint8)
+    img = img.reshape(patch_size[1], patch_size[0], slide_img.bands)
+    return img
+
+
+def grid_positions(shape, slide_name, df_res, PATCH_SIZE):
+    # Identify grid position of the predictions of a slide
+    df_res = df_res.reset_index()
+    df_res = df_res[df_res["sample"].str.startswith(slide_name + "_")]
+    if "x" in df_res.columns and "y" in df_res.columns:
+        xs = df_res["x"].to_numpy(dtype=np.int64)
+        ys = df_res["y"].to_numpy(dtype=np.int64)
+    else:
+        coords = df_res["sample"].str.extract(r"_(\d+)_(\d+)$").astype(np.int64)
+        xs = coords[0].to_numpy() // PATCH_SIZE[0] - 1
+        ys = coords[1].to_numpy() // PATCH_SIZE[1] - 1
+    # Ignore predictions outside of the grid
+    valid = (xs >= 0) & (xs < shape[0]) & (ys >= 0) & (ys < shape[1])
+    return df_res, xs, ys, valid
 
+def class_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE, soft=False):
+    """ Build the class color map of the tile grid with shape (n_tiles_x, n_tiles_y, 3).
+
+    Grid positions are taken from the integer columns x/y of the predictions or
+    parsed from the sample names otherwise. Tiles without prediction stay black.
+
+    Args:
+        soft (bool):    Blend palette colors by the predicted probabilities instead
+                        of using the color of the argmax class.
+    """
+    small_version = np.zeros((max_X // PATCH_SIZE[0], max_Y // PATCH_SIZE[1], 3),
+                             dtype=np.uint8)
+    df_res, xs, ys, valid = grid_positions(small_version.shape, slide_name, df_res,
+                                           PATCH_SIZE)
+
+    if soft:
+        probs = df_res[COL_NAMES].to_numpy(dtype=np.float32)
+        colors = np.clip(probs @ PALETTE.astype(np.float32), 0, 255).astype(np.uint8)
+    else:
+        labels = pd.Categorical(df_res["class"], categories=COL_NAMES).codes
+        colors = PALETTE[labels]
+        valid &= labels >= 0
+    small_version[xs[valid], ys[valid]] = colors[valid]
     return small_version
+
+def probability_reassemble(max_X, max_Y, slide_name, df_res, PATCH_SIZE):
+    """ Build the probability maps of the tile grid with shape (n_tiles_x, n_tiles_y, n_classes).
+
+    Tiles without prediction have a probability of zero for all classes.
+    """
+    probs = np.zeros((max_X // PATCH_SIZE[0], max_Y // PATCH_SIZE[1], len(COL_NAMES)),
+                     dtype=np.float32)
+    df_res, xs, ys, valid = grid_positions(probs.shape, slide_name, df_res,
+                                           PATCH_SIZE)
+    values = df_res[COL_NAMES].to_numpy(dtype=np.float32)
+    probs[xs[valid], ys[valid]] = values[valid]
+    return probs
+
+def render_class_map(small_version, PATCH_SIZE, img=None, alpha=0.3):
+    """ Render the class map of the tile grid at full slide resolution.
+
+    The whole chain stays in uint8 and is evaluated lazily by libvips, thus the
+    upscaled class map is never materialized and can be written with full thread
+    concurrency.
+
+    Args:
+        small_version (numpy.ndarray):  Class map as returned by class_reassemble.
+        PATCH_SIZE (tuple):             Tile size in pixels.
+        img (pyvips.Image):             Opened slide for an overlay. If None, only the class map is rendered.
+        alpha (float):                  Opacity of the class map in the overlay.
+
+    Returns:
+        res (pyvips.Image):             Rendered uint8 RGB image.
+    """
+    # Grid is indexed as [x, y], whereas images are indexed as [y, x]
+    grid = np.ascontiguousarray(np.transpose(small_version, (1, 0, 2)))
+    res = pyvips.Image.new_from_array(grid, interpretation="rgb")
+    # Nearest neighbor upscaling via pixel replication
+    res = res.zoom(PATCH_SIZE[0], PATCH_SIZE[1])
+    if img is not None:
+        # Blend class map and slide in uint8
+        res = res.embed(0, 0, img.width, img.height)
+        res = res.linear(alpha, 0, uchar=True) + \
+              img.linear(1.0 - alpha, 0, uchar=True)
+        res = res.cast("uchar").copy(interpretation="rgb")
+    return res
+
+# Suffixes of the output files of a slide
+OUTPUT_SUFFIXES = {"full": ["_gleason.tiff"],
+                   "grid": ["_gleason_grid.tiff", "_gleason_probs.tiff"]}
+
+def output_paths(path, slide_name, output_format="full"):
+    # Output files of a slide for the output format (full, grid or both)
+    formats = ["full", "grid"] if output_format == "both" else [output_format]
+    return [os.path.join(path, slide_name + suffix) \
+            for f in formats for suffix in OUTPUT_SUFFIXES[f]]
+
+def is_output(path):
+    return any(path.endswith(suffix) for suffixes in OUTPUT_SUFFIXES.values() \
+               for suffix in suffixes)
+
+def save_class_map(res, path, xres, yres, PATCH_SIZE):
+    # Store rendered class map as pyramidal BigTiff
+    props = {
+        "compression": "jpeg",
+        "xres": xres,
+        "yres": yres,
+        "tile": True,
+        "tile_width": PATCH_SIZE[0],
+        "tile_height": PATCH_SIZE[1],
+        "pyramid": True,
+        "bigtiff": True,
+    }
+    res.tiffsave(path, **props)
+
+def save_grid_maps(path_prefix, small_version, probs, xres, yres, PATCH_SIZE,
+                   slide_size):
+    """ Store class map and probability maps at the resolution of the tile grid.
+
+    Each pixel corresponds to one tile. Both maps are stored losslessly (deflate)
+    with the resolution scaled by the tile size, so that viewers can align them
+    with the slide. The image description contains the tile size, the slide size
+    and the class order as JSON.
+
+    Files:
+        <path_prefix>_grid.tiff:    RGB class map (uint8) colored by the class palette.
+        <path_prefix>_probs.tiff:   One page per class (order of COL_NAMES) with the
+                                    probabilities scaled to uint8 (0-255).
+    """
+    description = json.dumps({"tile_size": list(PATCH_SIZE),
+                              "slide_size": list(slide_size),
+                              "classes": COL_NAMES, "palette": PALETTE.tolist()})
+    props = {"compression": "deflate", "xres": xres / PATCH_SIZE[0],
+             "yres": yres / PATCH_SIZE[1]}
+    # Grid is indexed as [x, y], whereas images are indexed as [y, x]
+    grid = np.ascontiguousarray(np.transpose(small_version, (1, 0, 2)))
+    res = pyvips.Image.new_from_array(grid, interpretation="rgb")
+    res = res.copy()
+    res.set_type(pyvips.GValue.gstr_type, "image-description", description)
+    res.tiffsave(path_prefix + "_grid.tiff", **props)
+    # Probability maps as pages of a single multi-page TIFF
+    pages = np.rint(np.transpose(probs, (2, 1, 0)) * 255).astype(np.uint8)
+    res = pyvips.Image.new_from_array(pages.reshape(-1, pages.shape[2]),
+                                      interpretation="b-w")
+    res = res.copy()
+    res.set_type(pyvips.GValue.gint_type, "page-height", pages.shape[1])
+    res.set_type(pyvips.GValue.gstr_type, "image-description", description)
+    res.tiffsave(path_prefix + "_probs.tiff", **props)
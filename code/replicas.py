@@ -0,0 +1,261 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import sys
+import time
+import queue
+import secrets
+import threading
+import traceback
+import subprocess
+from functools import partial
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------#
+#                     Replica Pool                     #
+# -----------------------------------------------------#
+class ReplicaPool:
+    """ Inference replicas in separate processes, each pinned to a disjoint core set.
+
+    The available cores are split into one contiguous core set per replica. Each
+    replica is started with its CPU affinity, the TensorFlow intra-/inter-op thread
+    counts, the libvips thread pool and the loader workers restricted to its core set,
+    so that the replicas do not compete for cores. Tiles are fed in chunks from a
+    shared queue, thus idle replicas pick up the next chunk (dynamic load balancing).
+
+    Replicas are started as `python code/replicas.py` and connect back via an
+    authenticated local connection. Slides and tile cache entries are reopened by
+    the replicas (config keys slide_path/read_downsample and cache_entry).
+
+    Args:
+        settings (dict):        Models of the replicas: models (paths), nclasses, backend,
+                                threads, aggregate, ensemble_weights, cascade,
+                                cascade_threshold, cascade_criterion and load_weights.
+        replicas (int):         Number of replicas.
+        cores (list):           Cores to distribute. Default: CPU affinity of this process.
+        intra_op (int):         Intra-op threads per replica. Default: cores per replica.
+        inter_op (int):         Inter-op threads per replica. Default: TensorFlow default.
+        chunk_size (int):       Maximum number of tiles per queued chunk.
+        timeout (float):        Seconds to wait for replicas to start and load the models.
+    """
+    def __init__(self, settings, replicas=2, cores=None, intra_op=None, inter_op=None,
+                 chunk_size=128, timeout=600):
+        if cores is None : cores = sorted(os.sched_getaffinity(0))
+        if replicas < 1 or replicas > len(cores):
+            raise ValueError("Number of replicas has to be between 1 and the " + \
+                             "number of cores (" + str(len(cores)) + ")")
+        self.core_sets = [[int(c) for c in s] for s in np.array_split(cores, replicas)]
+        self.chunk_size = chunk_size
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.alive = replicas
+        self.threads = []
+        self.processes = []
+        key = secrets.token_bytes(32)
+        self.listener = Listener(authkey=key)
+        for index, core_set in enumerate(self.core_sets):
+            threads = intra_op if intra_op is not None else len(core_set)
+            env = dict(os.environ)
+            env.update({"DEEPGLEASON_REPLICA_ADDRESS": self.listener.address,
+                        "DEEPGLEASON_REPLICA_KEY": key.hex(),
+                        "DEEPGLEASON_REPLICA_INDEX": str(index),
+                        "OMP_NUM_THREADS": str(threads),
+                        "TF_NUM_INTRAOP_THREADS": str(threads),
+                        "VIPS_CONCURRENCY": str(len(core_set))})
+            if inter_op is not None : env["TF_NUM_INTEROP_THREADS"] = str(inter_op)
+            self.processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)], env=env,
+                preexec_fn=partial(os.sched_setaffinity, 0, core_set)))
+        # Connections are matched to replicas by the index sent after connecting
+        conns = {}
+        def accept():
+            for _ in range(replicas):
+                conn = self.listener.accept()
+                conns[conn.recv()] = conn
+        thread = threading.Thread(target=accept, daemon=True)
+        thread.start()
+        # Stop waiting as soon as a replica exited before connecting
+        deadline = time.monotonic() + timeout
+        while thread.is_alive() and time.monotonic() < deadline:
+            thread.join(1)
+            if any(p.poll() is not None for p in self.processes) : break
+        if len(conns) < replicas:
+            codes = [p.poll() for p in self.processes]
+            self.close()
+            raise RuntimeError("Inference replicas failed to start (exit codes: " + \
+                               str(codes) + ")")
+        for index, core_set in enumerate(self.core_sets):
+            threads = intra_op if intra_op is not None else len(core_set)
+            conns[index].send(dict(settings, intra_op=threads, inter_op=inter_op,
+                                   workers=len(core_set)))
+        for index in range(replicas):
+            if not conns[index].poll(timeout):
+                self.close()
+                raise RuntimeError("Inference replica " + str(index) + \
+                                   " failed to load the models")
+            try : status, res = conns[index].recv()
+            except EOFError : status, res = "error", "Replica terminated"
+            if status != "ready":
+                self.close()
+                raise RuntimeError("Inference replica " + str(index) + \
+                                   " failed to load the models:\n" + res)
+        for index in range(replicas):
+            thread = threading.Thread(target=self.serve, args=(conns[index],),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def serve(self, conn):
+        # Forward queued chunks to a replica one after another
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                conn.send(None)
+                conn.close()
+                return
+            future, payload = task
+            try:
+                conn.send(payload)
+                status, res = conn.recv()
+            except (EOFError, OSError):
+                future.set_exception(RuntimeError("Inference replica terminated"))
+                # Pending chunks fail once no replica is left to process them
+                with self.lock:
+                    self.alive -= 1
+                    if self.alive == 0 : self.fail_pending()
+                return
+            if status == "done" : future.set_result(res)
+            else : future.set_exception(RuntimeError(res))
+
+    def fail_pending(self):
+        while True:
+            try : task = self.tasks.get_nowait()
+            except queue.Empty : return
+            if task is not None:
+                task[0].set_exception(RuntimeError("All inference replicas terminated"))
+
+    def predict(self, x, config):
+        """ Predict tiles with all replicas (same arguments and result as run_aucmedi).
+
+        Chunks are at most chunk_size tiles, but small enough to occupy all replicas.
+        """
+        x = list(x)
+        size = max(1, min(self.chunk_size, -(-len(x) // len(self.core_sets))))
+        futures = []
+        with self.lock:
+            if self.alive == 0 : raise RuntimeError("All inference replicas terminated")
+            for i in range(0, max(len(x), 1), size):
+                chunk = x[i:i+size]
+                future = Future()
+                self.tasks.put((future, (chunk, portable_config(config, chunk))))
+                futures.append(future)
+        return pd.concat([f.result() for f in futures], ignore_index=True)
+
+    def close(self, timeout=60):
+        for _ in self.threads : self.tasks.put(None)
+        for thread in self.threads : thread.join(timeout)
+        for process in self.processes:
+            try : process.wait(timeout if self.threads else 0)
+            except subprocess.TimeoutExpired : process.kill()
+        self.listener.close()
+
+def portable_config(config, x):
+    # pyvips images and memory maps are reopened by the replicas
+    if config.get("slide_image") is not None and "slide_path" not in config:
+        raise ValueError("Inference replicas require the slide path (config slide_path)")
+    config = {k: v for k, v in config.items() \
+              if k not in ["slide_image", "cache_tiles", "cache_index"]}
+    if "tiles" in config : config["tiles"] = config["tiles"][config["tiles"]["sample"].isin(x)]
+    return config
+
+# -----------------------------------------------------#
+#                    Replica Process                   #
+# -----------------------------------------------------#
+def replica_main():
+    conn = Client(os.environ["DEEPGLEASON_REPLICA_ADDRESS"],
+                  authkey=bytes.fromhex(os.environ["DEEPGLEASON_REPLICA_KEY"]))
+    conn.send(int(os.environ["DEEPGLEASON_REPLICA_INDEX"]))
+    settings = conn.recv()
+    try:
+        # TensorFlow thread pools have to be configured before loading the models
+        import model as inference
+        from slide_reader import SlideReader
+        from tile_cache import TileCache
+        inference.configure_threads(settings["intra_op"], settings["inter_op"])
+        models = [inference.load_model(m, settings["nclasses"],
+                                       backend=settings["backend"],
+                                       num_threads=settings["threads"],
+                                       workers=settings["workers"],
+                                       load_weights=settings["load_weights"]) \
+                  for m in settings["models"]]
+        model = models[0]
+        if len(models) > 1:
+            model = inference.Ensemble(models, aggregate=settings["aggregate"],
+                                       weights=settings["ensemble_weights"])
+        model_screen = None
+        if settings["cascade"] is not None:
+            model_screen = inference.load_model(settings["cascade"], settings["nclasses"],
+                                                backend=settings["backend"],
+                                                num_threads=settings["threads"],
+                                                workers=settings["workers"],
+                                                load_weights=settings["load_weights"])
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ready", os.getpid()))
+
+    # Opened slide and tile cache entry of the last chunk
+    slide, entry = (None, None), (None, None)
+    while True:
+        try : task = conn.recv()
+        except EOFError : return
+        if task is None : return
+        x, config = task
+        try:
+            if "slide_path" in config:
+                key = (config["slide_path"], config.get("read_downsample", 1))
+                if slide[0] != key:
+                    slide = (key, SlideReader(key[0]).level(key[1])[0])
+                config["slide_image"] = slide[1]
+            if "cache_entry" in config:
+                key = tuple(config["cache_entry"])
+                if entry[0] != key:
+                    cache_tiles, cache_index = TileCache(key[0]).open(key[1], key[2])
+                    entry = (key, (cache_tiles, dict(zip(cache_index["sample"],
+                                                         range(len(cache_index))))))
+                config["cache_tiles"], config["cache_index"] = entry[1]
+            config["workers"] = settings["workers"]
+            # Cascade reports compare with a full run of the main model
+            if model_screen is None or config.get("full_model", False):
+                df = inference.run_aucmedi(x, model, config)
+            else:
+                df = inference.run_cascade(x, model_screen, model, config,
+                                           threshold=settings["cascade_threshold"],
+                                           criterion=settings["cascade_criterion"])
+            conn.send(("done", df))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+if __name__ == "__main__":
+    replica_main()
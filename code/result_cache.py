@@ -0,0 +1,149 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+from slide_reader import open_slide
+from store import model_columns
+from proc import COL_NAMES
+
+# Header fields identifying the slide layout
+HEADER_FIELDS = ["width", "height", "bands", "format", "xres", "yres",
+                 "page-height", "n-pages", "n-subifds"]
+
+# -----------------------------------------------------#
+#                     Content Hashes                   #
+# -----------------------------------------------------#
+def slide_hash(slide, n_blocks=64, block_size=65536):
+    """ Fast content hash of a slide based on sampled blocks and the pyvips header.
+
+    Instead of reading the whole slide, the file size and n_blocks blocks at evenly
+    spaced offsets (including the first and last block) are hashed. The slide
+    can be passed as path or as opened SlideReader (reusing its header).
+    """
+    reader = open_slide(slide)
+    h = hashlib.sha256()
+    size = os.path.getsize(reader.path)
+    h.update(str(size).encode())
+    with open(reader.path, "rb") as f:
+        offsets = np.linspace(0, max(size - block_size, 0), n_blocks).astype(np.int64)
+        for offset in np.unique(offsets):
+            f.seek(int(offset))
+            h.update(f.read(block_size))
+    fields = reader.header.get_fields()
+    header = {k: str(reader.header.get(k)) for k in HEADER_FIELDS if k in fields}
+    h.update(json.dumps(header, sort_keys=True).encode())
+    return h.hexdigest()
+
+def file_hash(paths, chunk_size=1024**2):
+    # Hash of the complete content of files (e.g. model weights) or directories
+    h = hashlib.sha256()
+    files = []
+    for path in paths:
+        if not os.path.isdir(path) : files.append(path)
+        else : files.extend(sorted(os.path.join(root, f) \
+                                   for root, _, fs in os.walk(path) for f in fs))
+    for path in files:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def result_key(slide_digest, model_digest, config):
+    # Predictions also depend on the inference configuration
+    h = hashlib.sha256()
+    h.update(slide_digest.encode())
+    h.update(model_digest.encode())
+    h.update(json.dumps(config, sort_keys=True).encode())
+    return h.hexdigest()
+
+# -----------------------------------------------------#
+#                      Result Cache                    #
+# -----------------------------------------------------#
+class ResultCache:
+    """ Content-addressed on-disk cache of slide predictions.
+
+    Entries are Feather files (`<key>.feather`) containing the tile grid position
+    (x/y), the soft labels, the predicted class and the model of each tile. Sample
+    names are not stored, as the same slide can be submitted under different names.
+    The cache is bounded in size by evicting the least recently used entries.
+
+    Args:
+        path (str):         Directory of the result cache. Created if not existing.
+        max_size (int):     Maximum size of all entries in bytes.
+    """
+    def __init__(self, path, max_size=1024**3):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ".feather")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        with self.lock:
+            # Entries may be evicted concurrently by other processes
+            try:
+                # Modification time marks the last usage for the LRU eviction
+                os.utime(path)
+                return pd.read_feather(path)
+            except FileNotFoundError:
+                return None
+
+    def put(self, key, df):
+        entry = pd.DataFrame({"x": df["x"].astype(np.int32),
+                              "y": df["y"].astype(np.int32)})
+        for c in COL_NAMES + model_columns(df):
+            entry[c] = df[c].astype(np.float32)
+        entry["class"] = df["class"].astype(str)
+        entry["model"] = df["model"].astype(str)
+        with self.lock:
+            # Write to temporary file first to never leave an incomplete entry behind
+            path_tmp = self.entry_path(key) + "." + str(os.getpid()) + ".tmp"
+            entry.reset_index(drop=True).to_feather(path_tmp)
+            os.replace(path_tmp, self.entry_path(key))
+            self.evict()
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits its size bound
+        # (entries may be evicted concurrently by other processes sharing the cache)
+        entries = []
+        for f in os.listdir(self.path):
+            if not f.endswith(".feather") : continue
+            try:
+                stat = os.stat(os.path.join(self.path, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for mtime, size, f in entries[:-1]:
+            if total <= self.max_size : break
+            total -= size
+            try : os.remove(os.path.join(self.path, f))
+            except FileNotFoundError : pass
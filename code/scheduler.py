@@ -0,0 +1,184 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import json
+import time
+import socket
+import threading
+
+# -----------------------------------------------------#
+#                      Work Queue                      #
+# -----------------------------------------------------#
+class WorkQueue:
+    """ Coordinates multiple workers processing slides from a shared directory.
+
+    Workers atomically claim a slide by creating a lock file (`locks/<slide_name>.lock`)
+    in the shared work directory. Locks of running workers are refreshed by a heartbeat
+    thread. Locks without heartbeat for `stale_timeout` seconds belong to crashed workers
+    and are recovered by the next worker. The status of each slide (running, done,
+    skipped or failed) is recorded in `status/<slide_name>.json`. If slides are
+    processed in shards, each part is claimed separately (`<slide_name>.part-<part>`).
+
+    Args:
+        path (str):             Shared work directory. Created if not existing.
+        heartbeat (float):      Seconds between refreshes of held locks.
+        stale_timeout (float):  Seconds without heartbeat after which a lock is stale.
+        max_attempts (int):     Number of attempts before a failed slide is given up.
+        part (str):             Part of the slides processed by this worker (sharding).
+    """
+    def __init__(self, path, heartbeat=30, stale_timeout=300, max_attempts=3,
+                 part=None):
+        self.path = path
+        self.part = part
+        self.heartbeat = heartbeat
+        self.stale_timeout = stale_timeout
+        self.max_attempts = max_attempts
+        self.worker = socket.gethostname() + ":" + str(os.getpid())
+        self.held = {}
+        self.lock = threading.Lock()
+        for d in ["locks", "status"]:
+            os.makedirs(os.path.join(self.path, d), exist_ok=True)
+        thread = threading.Thread(target=self._heartbeat, daemon=True)
+        thread.start()
+
+    def name(self, slide):
+        slide_name = os.path.basename(slide)
+        slide_name = slide_name[: slide_name.find(".")]
+        if self.part is not None : slide_name += ".part-" + self.part
+        return slide_name
+
+    def lock_path(self, slide_name):
+        return os.path.join(self.path, "locks", slide_name + ".lock")
+
+    def status_path(self, slide_name):
+        return os.path.join(self.path, "status", slide_name + ".json")
+
+    #---------------------------------------------#
+    #                 Slide Status                #
+    #---------------------------------------------#
+    def status(self, slide_name):
+        try:
+            with open(self.status_path(slide_name), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def set_status(self, slide_name, status, **kwargs):
+        previous = self.status(slide_name) or {}
+        record = {"status": status, "worker": self.worker, "time": time.time(),
+                  "attempts": previous.get("attempts", 0)}
+        if status == "running" : record["attempts"] += 1
+        record.update(kwargs)
+        # Write to temporary file first to never leave an incomplete status behind
+        path_tmp = self.status_path(slide_name) + "." + str(os.getpid()) + ".tmp"
+        with open(path_tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(path_tmp, self.status_path(slide_name))
+
+    def pending(self, slide_name):
+        # Slides are processed unless finished or failed too often
+        status = self.status(slide_name)
+        if status is None : return True
+        if status["status"] in ["done", "skipped"] : return False
+        return status["attempts"] < self.max_attempts
+
+    #---------------------------------------------#
+    #                    Locking                  #
+    #---------------------------------------------#
+    def try_claim(self, slide_name):
+        path = self.lock_path(slide_name)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self.recover(path) : return False
+            return self.try_claim(slide_name)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker, "time": time.time()}, f)
+        with self.lock:
+            self.held[slide_name] = path
+        return True
+
+    def recover(self, path):
+        # Remove the lock of a crashed worker (no heartbeat within the stale timeout)
+        try:
+            if time.time() - os.path.getmtime(path) < self.stale_timeout:
+                return False
+            # Only a single worker succeeds in moving the stale lock away
+            path_stale = path + "." + self.worker.replace(":", "_") + ".stale"
+            os.rename(path, path_stale)
+        except FileNotFoundError:
+            return False
+        # Restore the lock if it was refreshed or claimed again in the meantime
+        if time.time() - os.path.getmtime(path_stale) < self.stale_timeout:
+            try : os.link(path_stale, path)
+            except FileExistsError : pass
+            os.remove(path_stale)
+            return False
+        os.remove(path_stale)
+        print("Recovered stale lock:", os.path.basename(path))
+        return True
+
+    def release(self, slide, status, **kwargs):
+        slide_name = self.name(slide)
+        self.set_status(slide_name, status, **kwargs)
+        with self.lock:
+            path = self.held.pop(slide_name, None)
+        if path is None : return
+        # Only remove the lock if it was not taken over by another worker
+        try:
+            with open(path, "r") as f:
+                owner = json.load(f)["worker"]
+            if owner == self.worker : os.remove(path)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                paths = list(self.held.values())
+            for path in paths:
+                try : os.utime(path)
+                except FileNotFoundError : pass
+
+    #---------------------------------------------#
+    #                  Claim Slides               #
+    #---------------------------------------------#
+    def claim(self, slides, sort=True):
+        """ Yield the slides claimed by this worker.
+
+        Args:
+            slides (iterable):      Paths of slides (e.g. a directory listing or manifest).
+            sort (bool):            Process large slides first for load balancing.
+        """
+        if sort : slides = sorted(slides, key=os.path.getsize, reverse=True)
+        for slide in slides:
+            slide_name = self.name(slide)
+            if not self.pending(slide_name) or not self.try_claim(slide_name):
+                continue
+            # Status may have changed between the check and the claim
+            if not self.pending(slide_name):
+                with self.lock:
+                    path = self.held.pop(slide_name)
+                os.remove(path)
+                continue
+            self.set_status(slide_name, "running")
+            yield slide
@@ -0,0 +1,177 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import threading
+import pyvips
+
+# -----------------------------------------------------#
+#                     Slide Reader                     #
+# -----------------------------------------------------#
+class SlideReader:
+    """ Opens a slide once and provides its RGB image at full or reduced resolution.
+
+    The slide format and channel layout are detected from the header:
+        format:     "openslide" (formats loaded via OpenSlide, e.g. SVS, NDPI, MRXS),
+                    "ome-tiff", "tiff" or the name of another libvips loader.
+        layout:     "interleaved" (RGB(A) pages) or "channels" (one page per RGB
+                    channel, e.g. DeepGleason slides or OME-TIFF channel planes).
+
+    Opened images are cached per pyramid level and access pattern, so that all stages
+    of a slide (tissue mask, tile reading and overlay writing) share one handle and
+    its decoded tiles. Tile reading requires random access ("random"), whereas
+    streaming the whole image (e.g. writing the overlay) only requires sequential
+    access ("sequential"), which decodes each tile once and keeps little in memory.
+    An already opened random access handle also serves sequential reads.
+
+    Args:
+        path (str):     Path to the slide.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.images = {}
+        self.header = pyvips.Image.new_from_file(path)
+        fields = self.header.get_fields()
+        loader = self.header.get("vips-loader") if "vips-loader" in fields else ""
+        description = self.header.get("image-description") \
+                      if "image-description" in fields else ""
+        if loader.startswith("openslide") : self.format = "openslide"
+        elif loader.startswith("tiff") and "<OME" in description : self.format = "ome-tiff"
+        elif loader.startswith("tiff") : self.format = "tiff"
+        else : self.format = loader
+        self.n_pages = self.header.get("n-pages") if "n-pages" in fields else 1
+        if self.header.bands >= 3 : self.layout = "interleaved"
+        elif self.header.bands == 1 and self.n_pages >= 3 : self.layout = "channels"
+        else:
+            raise ValueError("Unsupported slide layout: " + path + " (" + \
+                             str(self.header.bands) + " bands, " + \
+                             str(self.n_pages) + " pages)")
+        self.width = self.header.width
+        self.height = self.header.height
+        self.xres = self.header.get("xres")
+        self.yres = self.header.get("yres")
+        self._levels = None
+        # Header of interleaved slides already is the full resolution image
+        if self.layout == "interleaved":
+            self.images[((), "random")] = self.prepare(self.header)
+
+    def prepare(self, img):
+        # RGB image with a white background for transparent regions (e.g. OpenSlide)
+        if img.hasalpha() : img = img.flatten(background=255)
+        if img.bands > 3 : img = img.extract_band(0, n=3)
+        return img.copy(interpretation="rgb")
+
+    def open(self, access="random", **kwargs):
+        if self.layout == "interleaved":
+            img = pyvips.Image.new_from_file(self.path, access=access, **kwargs)
+            return self.prepare(img)
+        if access == "sequential":
+            # Channel pages are streamed in parallel from top to bottom
+            pages = [pyvips.Image.new_from_file(self.path, page=p, access=access,
+                                                **kwargs) for p in range(3)]
+        else:
+            # Single handle on the first three pages stacked vertically
+            img = pyvips.Image.new_from_file(self.path, n=3, access=access, **kwargs)
+            h = img.get("page-height")
+            pages = [img.crop(0, p * h, img.width, h) for p in range(3)]
+        return pages[0].bandjoin(pages[1:]).copy(interpretation="rgb")
+
+    def cached(self, access="random", **kwargs):
+        key = tuple(sorted(kwargs.items()))
+        with self.lock:
+            # Random access handles also serve sequential reads
+            for a in ["random", access]:
+                if (key, a) in self.images : return self.images[(key, a)]
+            self.images[(key, access)] = self.open(access, **kwargs)
+            return self.images[(key, access)]
+
+    def levels(self):
+        """ Pyramid levels of the slide as list of (downsampling factor, load options).
+
+        Levels are OpenSlide levels, sub-IFDs of the first page or pages of an
+        interleaved page pyramid. Only levels with an integer factor are used (level
+        dimensions may be rounded up or down, as written by libvips or scanners).
+        """
+        if self._levels is not None : return self._levels
+        levels = []
+        fields = self.header.get_fields()
+        if self.format == "openslide":
+            for i in range(int(self.header.get("openslide.level-count"))):
+                factor = float(self.header.get("openslide.level[%d].downsample" % i))
+                if i > 0 and abs(factor - round(factor)) < 0.01:
+                    levels.append((int(round(factor)), {"level": i}))
+        elif "n-subifds" in fields:
+            for i in range(self.header.get("n-subifds")):
+                level = pyvips.Image.new_from_file(self.path, subifd=i)
+                factor = self.factor(level)
+                if factor is not None : levels.append((factor, {"subifd": i}))
+        elif self.layout == "interleaved":
+            for i in range(1, self.n_pages):
+                level = pyvips.Image.new_from_file(self.path, page=i)
+                factor = self.factor(level)
+                if factor is not None : levels.append((factor, {"page": i}))
+        self._levels = levels
+        return levels
+
+    def factor(self, level):
+        # Integer downsampling factor of a level or None (e.g. label or macro images)
+        factor = round(self.width / level.width)
+        widths = [self.width // factor, -(-self.width // factor)]
+        heights = [self.height // factor, -(-self.height // factor)]
+        if factor < 2 or level.width not in widths or level.height not in heights:
+            return None
+        return factor
+
+    def image(self, access="random"):
+        # Slide at full resolution
+        return self.cached(access)
+
+    def level(self, downsample, access="random"):
+        """ Slide at a reduced resolution for reading tiles.
+
+        The pyramid level closest to but not below the target resolution is used and
+        the remaining factor is reduced lazily via libvips (box filter). The effective
+        downsampling factor is not larger than the requested one.
+
+        Returns:
+            img (pyvips.Image):     Slide at the reduced resolution.
+            factor (int):           Effective downsampling factor.
+        """
+        if downsample < 2 : return self.image(access), 1
+        factor, kwargs = 1, {}
+        for f, level_kwargs in self.levels():
+            if f <= downsample and f > factor : factor, kwargs = f, level_kwargs
+        img = self.cached(access, **kwargs)
+        remaining = 1
+        while factor * remaining * 2 <= downsample : remaining *= 2
+        if remaining > 1 : img = img.shrink(remaining, remaining)
+        return img, factor * remaining
+
+    def thumbnail(self, width, height):
+        # Thumbnail of the slide based on the closest pyramid level
+        downsample = max(1, min(self.width // max(width, 1),
+                                self.height // max(height, 1)))
+        img, _ = self.level(downsample)
+        return img.thumbnail_image(width, height=height, size="force")
+
+def open_slide(slide):
+    # Slides may be passed as path or as already opened SlideReader
+    if isinstance(slide, SlideReader) : return slide
+    return SlideReader(slide)
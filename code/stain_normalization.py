@@ -21,12 +21,115 @@
 #-----------------------------------------------------#
 # External libraries
 import numpy as np
-from PIL import Image
-# Histolab libraries
-from histolab.stain_normalizer import ReinhardStainNormalizer
+from scipy import ndimage
 # Internal libraries/scripts
 from aucmedi.data_processing.subfunctions.sf_base import Subfunction_Base
 
+#-----------------------------------------------------#
+#                Color Space Conversion               #
+#-----------------------------------------------------#
+# sRGB (D65) <-> CIE XYZ conversion matrices
+XYZ_FROM_RGB = np.array([[0.412453, 0.357580, 0.180423],
+                         [0.212671, 0.715160, 0.072169],
+                         [0.019334, 0.119193, 0.950227]], dtype=np.float32)
+RGB_FROM_XYZ = np.linalg.inv(XYZ_FROM_RGB).astype(np.float32)
+# Reference white of the D65 illuminant (2° observer)
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+def rgb2lab(rgb):
+    """ Convert uint8 RGB images with shape (..., 3) to CIE-LAB in float32.
+
+    Identical formulation as skimage.color.rgb2lab, which is used by histolab.
+    """
+    rgb = rgb.astype(np.float32) / 255.0
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = (rgb @ XYZ_FROM_RGB.T) / WHITE_D65
+    xyz = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    return np.stack([116.0 * y - 16.0, 500.0 * (x - y), 200.0 * (y - z)], axis=-1)
+
+def lab2rgb(lab):
+    """ Convert CIE-LAB images with shape (..., 3) to RGB in float32 within [0, 1].
+
+    Identical formulation as skimage.color.lab2rgb, which is used by histolab.
+    """
+    y = (lab[..., 0] + 16.0) / 116.0
+    x = lab[..., 1] / 500.0 + y
+    z = np.maximum(y - lab[..., 2] / 200.0, 0.0)
+    xyz = np.stack([x, y, z], axis=-1)
+    xyz = np.where(xyz > 0.2068966, xyz ** 3, (xyz - 16.0 / 116.0) / 7.787)
+    rgb = (xyz * WHITE_D65) @ RGB_FROM_XYZ.T
+    rgb = np.where(rgb > 0.0031308,
+                   1.055 * np.power(np.maximum(rgb, 0.0031308), 1 / 2.4) - 0.055,
+                   12.92 * rgb)
+    return np.clip(rgb, 0.0, 1.0)
+
+def tissue_masks(rgb, dilation=2, border=10, fill_size=20):
+    """ Compute tissue masks for a batch of uint8 RGB images with shape (N, H, W, 3).
+
+    Tissue is defined as all pixels darker than the Otsu threshold of the
+    grayscale image (computed individually for each image), followed by a binary
+    dilation with a disk-shaped structuring element and the filling of holes
+    (e.g. gland lumina) with a square structuring element as in histolab. As in
+    histolab, the filters are applied on the images with a white border.
+    """
+    # Grayscale conversion via ITU-R 601-2 luma transform (fixed-point as in Pillow)
+    rgb = rgb.astype(np.uint32)
+    gray = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + \
+            0x8000) >> 16
+    gray = gray.reshape(len(rgb), -1)
+    # Compute histogram of each image in a single bincount call
+    offsets = np.arange(len(rgb))[:, None] * 256
+    hist = np.bincount((gray + offsets).ravel(), minlength=len(rgb) * 256)
+    hist = hist.reshape(len(rgb), 256).astype(np.float64)
+    # White border pixels
+    n, h, w = rgb.shape[:-1]
+    hist[:, 255] += (h + 2 * border) * (w + 2 * border) - h * w
+    # Otsu threshold: maximize between-class variance
+    bins = np.arange(256)
+    weight_bg = np.cumsum(hist, axis=1)
+    weight_fg = weight_bg[:, -1:] - weight_bg
+    cumsum_bins = np.cumsum(hist * bins, axis=1)
+    mean_bg = cumsum_bins / np.maximum(weight_bg, 1)
+    mean_fg = (cumsum_bins[:, -1:] - cumsum_bins) / np.maximum(weight_fg, 1)
+    variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    threshold = np.argmax(variance, axis=1)[:, None]
+    # Tissue pixels are darker than the background
+    mask = (gray < threshold).reshape(n, h, w)
+    mask = np.pad(mask, ((0, 0), (border, border), (border, border)))
+    # Binary dilation via shifted maxima over a disk-shaped neighborhood
+    if dilation > 0:
+        ph, pw = mask.shape[1:]
+        padded = np.pad(mask, ((0, 0), (dilation, dilation), (dilation, dilation)))
+        dilated = np.zeros_like(mask)
+        for dy in range(-dilation, dilation + 1):
+            for dx in range(-dilation, dilation + 1):
+                if dy * dy + dx * dx > dilation * dilation : continue
+                dilated |= padded[:, dilation + dy:dilation + dy + ph,
+                                     dilation + dx:dilation + dx + pw]
+        mask = dilated
+    # Fill holes enclosed by tissue
+    if fill_size > 0:
+        structure = np.ones((fill_size, fill_size))
+        mask = np.stack([ndimage.binary_fill_holes(m, structure=structure) \
+                         for m in mask])
+    return mask[:, border:border + h, border:border + w]
+
+def lab_statistics(lab, mask):
+    """ Compute per-image channel mean and standard deviation over the masked pixels.
+
+    Returns:
+        means, stds (numpy.ndarray):    Arrays with shape (N, 3).
+    """
+    # Fall back to all pixels if no tissue has been detected
+    empty = ~mask.any(axis=(1, 2))
+    mask = mask | empty[:, None, None]
+    weights = mask[..., None].astype(np.float32)
+    count = weights.sum(axis=(1, 2))
+    means = (lab * weights).sum(axis=(1, 2)) / count
+    variance = (((lab - means[:, None, None]) ** 2) * weights).sum(axis=(1, 2)) / count
+    return means, np.sqrt(variance)
+
 #-----------------------------------------------------#
 #       Subfunction class: Stain Normalization        #
 #-----------------------------------------------------#
@@ -42,6 +145,10 @@ class StainNormalization(Subfunction_Base):
     
     The provided source image should be the same for reproducible results.
 
+    The normalization is a vectorized NumPy implementation of histolab's
+    ReinhardStainNormalizer, which can also be applied on a complete batch
+    with shape (N, H, W, 3) via `transform_batch`.
+
     Reference:
         Reinhard, Erik, et al. “Color transfer between images.” IEEE Computer graphics and applications 21.5 (2001)
     """
@@ -57,20 +164,39 @@ class StainNormalization(Subfunction_Base):
         """
         # Cache source image
         self.target = source_image.convert("RGB")
-        # Initialize & fit stain normalizer
-        self.normalizer = ReinhardStainNormalizer()
-        self.normalizer.fit(self.target)
+        # Precompute target LAB statistics on tissue pixels
+        target = np.asarray(self.target)[None]
+        target_lab = rgb2lab(target)
+        means, stds = lab_statistics(target_lab, tissue_masks(target))
+        self.target_means = means[0]
+        self.target_stds = stds[0]
 
     #---------------------------------------------#
     #                Transformation               #
     #---------------------------------------------#
     def transform(self, image):
-        image_clipped = np.clip(image, a_min=0, a_max=255)
-        # Convert target image from NumPy to Pillow
-        image_pillow = Image.fromarray(image_clipped).convert("RGB")
-        # Apply stain normalization via histolab
-        image_pillow_normalized = self.normalizer.transform(image_pillow)
-        # Convert target image back from Pillow to NumPy
-        image_normalized = np.asarray(image_pillow_normalized)
-        # Return normalized image
-        return image_normalized
+        # Normalize single image as batch of size one
+        return self.transform_batch(image[None])[0]
+
+    def transform_batch(self, images):
+        """ Apply stain normalization on a batch of images.
+
+        Args:
+            images (numpy.ndarray):     Batch of RGB images with shape (N, H, W, 3).
+
+        Returns:
+            images (numpy.ndarray):     Batch of normalized uint8 RGB images with shape (N, H, W, 3).
+        """
+        images = np.clip(images, a_min=0, a_max=255).astype(np.uint8)
+        # Compute LAB statistics of all images on tissue pixels
+        mask = tissue_masks(images)
+        images_lab = rgb2lab(images)
+        means, stds = lab_statistics(images_lab, mask)
+        # Transfer LAB statistics of the target image to tissue pixels
+        scale = self.target_stds / np.maximum(stds, 1e-6)
+        norm_lab = (images_lab - means[:, None, None]) * scale[:, None, None] + \
+                   self.target_means
+        norm_lab = np.where(mask[..., None], norm_lab, images_lab)
+        # Convert back to uint8 RGB
+        images_normalized = np.rint(lab2rgb(norm_lab) * 255).astype(np.uint8)
+        return images_normalized
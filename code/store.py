@@ -0,0 +1,178 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import numpy as np
+import pandas as pd
+
+from proc import COL_NAMES
+
+# -----------------------------------------------------#
+#                   Prediction Store                   #
+# -----------------------------------------------------#
+def model_columns(df):
+    # Soft label columns of individual ensemble models ("<class>.<architecture>")
+    return [c for c in df.columns if "." in c and c.split(".")[0] in COL_NAMES]
+
+class PredictionStore:
+    """ Append-only columnar storage of tile predictions.
+
+    Each slide is stored as a separate Feather shard (`<slide_name>.feather`) in the
+    store directory, so that adding a slide never touches the data of other slides.
+    Shards contain the sample name, the integer tile grid position (x/y), the
+    float32 soft labels, the predicted class and the model which decided the tile.
+    For ensembles, the soft labels of each model are kept in additional columns
+    named `<class>.<architecture>`.
+
+    Slides processed in shards by multiple processes are first stored as partial
+    shards (`<slide_name>.part-<part>.feather`), which are merged into
+    the slide shard afterwards (see merge.py).
+
+    During inference, scored tiles of an unfinished slide are checkpointed in a
+    progress file (`<slide_name>.progress.csv`), which is removed as soon as the
+    slide shard is written.
+
+    Args:
+        path (str):     Directory of the prediction store. Created if not existing.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def shard_path(self, slide_name):
+        return os.path.join(self.path, slide_name + ".feather")
+
+    def append(self, slide_name, df):
+        # Normalize column types
+        df = df.reset_index(drop=True)
+        shard = pd.DataFrame({"sample": df["sample"].astype(str)})
+        shard["x"] = df["x"].astype(np.int32)
+        shard["y"] = df["y"].astype(np.int32)
+        for c in COL_NAMES:
+            shard[c] = df[c].astype(np.float32)
+        shard["class"] = df["class"].astype(str)
+        shard["model"] = df["model"].astype(str)
+        for c in model_columns(df):
+            shard[c] = df[c].astype(np.float32)
+        # Write to temporary file first to never leave an incomplete shard behind
+        path_tmp = self.shard_path(slide_name) + ".tmp"
+        shard.to_feather(path_tmp)
+        os.replace(path_tmp, self.shard_path(slide_name))
+
+    def slides(self):
+        # Partial shards are identified by a dot as slide names never contain one
+        return sorted(f[:-len(".feather")] for f in os.listdir(self.path) \
+                      if f.endswith(".feather") and f.count(".") == 1)
+
+    def contains(self, slide_name):
+        return os.path.exists(self.shard_path(slide_name))
+
+    def load(self, slide_name=None):
+        """ Load the predictions of a single slide or of all slides.
+
+        Args:
+            slide_name (str):       Name of the slide. If None, all slides are loaded.
+
+        Returns:
+            df (pandas.DataFrame):  Predictions with an additional column "slide".
+        """
+        slides = self.slides() if slide_name is None else [slide_name]
+        shards = []
+        for s in slides:
+            shard = pd.read_feather(self.shard_path(s))
+            shard.insert(0, "slide", s)
+            shards.append(shard)
+        if len(shards) == 0:
+            return pd.DataFrame(columns=["slide", "sample", "x", "y"] + \
+                                        COL_NAMES + ["class", "model"])
+        return pd.concat(shards, ignore_index=True)
+
+    #---------------------------------------------#
+    #            Partial Shards of a Slide        #
+    #---------------------------------------------#
+    def partial_name(self, slide_name, part):
+        return "%s.part-%s" % (slide_name, part)
+
+    def partials(self, slide_name):
+        # Names of all partial shards of a slide
+        prefix = slide_name + ".part-"
+        return sorted(f[:-len(".feather")] for f in os.listdir(self.path) \
+                      if f.startswith(prefix) and f.endswith(".feather"))
+
+    def load_partials(self, slide_name):
+        shards = [pd.read_feather(self.shard_path(p)) \
+                  for p in self.partials(slide_name)]
+        if len(shards) == 0 : return None
+        df = pd.concat(shards, ignore_index=True)
+        return df.drop_duplicates(subset="sample", keep="last")
+
+    def clear_partials(self, slide_name):
+        for p in self.partials(slide_name):
+            os.remove(self.shard_path(p))
+
+    #---------------------------------------------#
+    #           Checkpointing of Inference        #
+    #---------------------------------------------#
+    def progress_path(self, slide_name):
+        return os.path.join(self.path, slide_name + ".progress.csv")
+
+    def append_progress(self, slide_name, df):
+        # Append scored tiles of an unfinished slide to its progress file
+        path = self.progress_path(slide_name)
+        # Terminate a line truncated by an interruption (dropped when loading)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n" : f.write(b"\n")
+        df[["sample"] + COL_NAMES + ["class", "model"] + model_columns(df)].to_csv(
+            path, mode="a", header=not os.path.exists(path), index=False
+        )
+
+    def load_progress(self, slide_name):
+        path = self.progress_path(slide_name)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=["sample"] + COL_NAMES + ["class", "model"])
+        # Tiles of an interrupted write may be incomplete, thus duplicates are dropped
+        df = pd.read_csv(path).dropna()
+        return df.drop_duplicates(subset="sample", keep="last")
+
+    def resume(self, slide_name, samples):
+        """ Split the tiles of a slide into already scored and remaining tiles.
+
+        Returns:
+            df_done (pandas.DataFrame):     Predictions of tiles scored before an interruption.
+            x (list):                       Sample names of the tiles still to predict.
+        """
+        df_done = self.load_progress(slide_name)
+        df_done = df_done[df_done["sample"].isin(samples)]
+        done = set(df_done["sample"])
+        return df_done, [s for s in samples if s not in done]
+
+    def clear_progress(self, slide_name):
+        path = self.progress_path(slide_name)
+        if os.path.exists(path) : os.remove(path)
+
+    def export_csv(self, path):
+        df = self.load()
+        # Replace atomically as multiple workers may export concurrently
+        path_tmp = path + "." + str(os.getpid()) + ".tmp"
+        df.drop(columns=["slide"]).to_csv(path_tmp, index=False)
+        os.replace(path_tmp, path)
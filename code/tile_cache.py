@@ -0,0 +1,133 @@
+# =============================================================================#
+#  Author:       Dominik Müller, Philip Meyer                                  #
+#  Copyright:    2024 AG-RAIMIA-Müller, University of Augsburg                 #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+# =============================================================================#
+# -----------------------------------------------------#
+#                    Library imports                   #
+# -----------------------------------------------------#
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------#
+#                      Tile Cache                      #
+# -----------------------------------------------------#
+class TileCache:
+    """ Persistent cache of preprocessed tiles (padded, resized & stain normalized).
+
+    The tiles of a slide are stored as a single uint8 array file with shape
+    (n_tiles, height, width, 3) in NumPy format, which is memory-mapped for reading,
+    together with an index of sample names and tile grid positions (Feather).
+    Entries are identified by the slide name and the tile resolution
+    (`<slide_name>.<width>x<height>/`), thus all models with the same input
+    resolution (e.g. DenseNet121 and ConvNeXtBase) and re-runs share an entry.
+    The settings the tiles were preprocessed with (e.g. slide content hash, read
+    downsampling and stain normalization order) are stored with each entry
+    (settings.json), so that entries of a changed slide or preprocessing are not
+    reused.
+
+    Args:
+        path (str):     Directory of the tile cache. Created if not existing.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def entry_path(self, slide_name, shape):
+        return os.path.join(self.path, "%s.%dx%d" % (slide_name, shape[0], shape[1]))
+
+    def contains(self, slide_name, shape, samples=None, settings=None):
+        path = self.entry_path(slide_name, shape)
+        path_index = os.path.join(path, "index.feather")
+        if not os.path.exists(path_index) : return False
+        # Entry has to be preprocessed with the same settings
+        if settings is not None and self.settings(slide_name, shape) != \
+            json.loads(json.dumps(settings)) : return False
+        if samples is None : return True
+        # Entry has to provide all requested tiles
+        index = pd.read_feather(path_index)
+        return set(samples).issubset(index["sample"])
+
+    def settings(self, slide_name, shape):
+        path = os.path.join(self.entry_path(slide_name, shape), "settings.json")
+        if not os.path.exists(path) : return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def write(self, slide_name, shape, tiles, chunks, settings=None):
+        """ Write the preprocessed tiles of a slide chunk by chunk.
+
+        Args:
+            slide_name (str):           Name of the slide.
+            shape (tuple):              Tile resolution (width, height).
+            tiles (pandas.DataFrame):   Tiles with columns sample, x and y.
+            chunks (iterable):          Arrays of consecutive preprocessed tiles with shape
+                                        (n, height, width, 3) in the order of tiles.
+            settings (dict):            Preprocessing settings (JSON serializable) of the tiles.
+        """
+        path = self.entry_path(slide_name, shape)
+        # Write to temporary directory first to never leave an incomplete entry behind
+        path_tmp = path + ".tmp"
+        if os.path.exists(path_tmp) : shutil.rmtree(path_tmp)
+        os.makedirs(path_tmp)
+        array = np.lib.format.open_memmap(os.path.join(path_tmp, "tiles.npy"),
+                                          mode="w+", dtype=np.uint8,
+                                          shape=(len(tiles), shape[1], shape[0], 3))
+        i = 0
+        for chunk in chunks:
+            array[i:i+len(chunk)] = chunk
+            i += len(chunk)
+        array.flush()
+        del array
+        index = pd.DataFrame({"sample": tiles["sample"].astype(str).to_numpy(),
+                              "x": tiles["x"].astype(np.int32).to_numpy(),
+                              "y": tiles["y"].astype(np.int32).to_numpy()})
+        index.to_feather(os.path.join(path_tmp, "index.feather"))
+        if settings is not None:
+            with open(os.path.join(path_tmp, "settings.json"), "w") as f:
+                json.dump(settings, f, sort_keys=True)
+        if os.path.exists(path) : shutil.rmtree(path)
+        os.replace(path_tmp, path)
+
+    def open(self, slide_name, shape):
+        """ Open the tiles of a slide memory-mapped (read-only, zero-copy).
+
+        Returns:
+            tiles (numpy.memmap):       Preprocessed tiles with shape (n_tiles, height, width, 3).
+            index (pandas.DataFrame):   Sample names and grid positions of the tiles.
+        """
+        path = self.entry_path(slide_name, shape)
+        tiles = np.load(os.path.join(path, "tiles.npy"), mmap_mode="r")
+        index = pd.read_feather(os.path.join(path, "index.feather"))
+        return tiles, index
+
+    def remove(self, slide_name, shape):
+        path = self.entry_path(slide_name, shape)
+        if os.path.exists(path) : shutil.rmtree(path)
+
+def cache_loader(sample, path_imagedir, image_format=None, grayscale=False,
+                 cache_tiles=None, cache_index=None, **kwargs):
+    """ AUCMEDI loader for preprocessed tiles of a TileCache entry.
+
+    Args:
+        sample (str):               Sample name of the tile.
+        cache_tiles (numpy.memmap): Tiles as returned by TileCache.open.
+        cache_index (dict):         Mapping of sample names to their row in cache_tiles.
+    """
+    return cache_tiles[cache_index[sample]]
@@ -0,0 +1,87 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from proc import tile_grid, COL_NAMES
+from adaptive import run_adaptive, adaptive_report
+
+#------------------------------------------------------#
+#               Unittest: Adaptive Inference           #
+#------------------------------------------------------#
+class DeepGleasonAdaptive(unittest.TestCase):
+    # Create a tile grid with spatially coherent regions of three classes
+    @classmethod
+    def setUpClass(self):
+        self.tiles = tile_grid(20 * 1024, 16 * 1024, "slide", (1024, 1024))
+        labels = np.where(self.tiles["x"] < 8, 1, 3)
+        labels[(self.tiles["x"] >= 12) & (self.tiles["y"] >= 10)] = 4
+        probs = np.full((len(self.tiles), len(COL_NAMES)), 0.01)
+        probs[np.arange(len(self.tiles)), labels] = 1 - 0.01 * (len(COL_NAMES) - 1)
+        self.dense = pd.DataFrame(probs, columns=COL_NAMES)
+        self.dense["sample"] = self.tiles["sample"]
+        self.dense["class"] = self.dense[COL_NAMES].idxmax(axis=1)
+        self.dense["model"] = "DenseNet121"
+
+    def oracle(self, requested):
+        # Prediction function returning the dense predictions of the requested tiles
+        def predict(x):
+            self.assertTrue(len(set(x) & requested) == 0)
+            requested.update(x)
+            return self.dense.set_index("sample").loc[x].reset_index()
+        return predict
+
+    def test_adaptive(self):
+        requested = set()
+        x = list(self.tiles["sample"])
+        df = run_adaptive(x, self.tiles, self.oracle(requested), stride=2)
+        self.assertEqual(sorted(df["sample"]), sorted(x))
+        self.assertEqual(len(requested), (df["model"] != "interpolated").sum())
+        self.assertLess(len(requested), len(x) / 2)
+        report = adaptive_report(df, self.dense, 1.0, 2.0)
+        self.assertEqual(report["agreement"], 1.0)
+        self.assertEqual(report["speedup"], 2.0)
+
+    def test_uncertain_neighbours(self):
+        # Neighbours below the confidence threshold lead to dense scoring
+        requested = set()
+        x = list(self.tiles["sample"])
+        run_adaptive(x, self.tiles, self.oracle(requested), stride=2, threshold=1.0)
+        self.assertEqual(len(requested), len(x))
+
+    def test_known_neighbours(self):
+        # Tiles without scored lattice neighbours are scored
+        requested = set()
+        x = [s for s, px, py in zip(self.tiles["sample"], self.tiles["x"],
+                                    self.tiles["y"]) if px % 2 == 1 and py % 2 == 1]
+        df = run_adaptive(x, self.tiles, self.oracle(requested), stride=2)
+        self.assertEqual(len(requested), len(x))
+        # Known predictions (e.g. background tiles) serve as neighbours
+        requested = set()
+        known = self.dense[~self.dense["sample"].isin(x)]
+        df = run_adaptive(x, self.tiles, self.oracle(requested), known=known, stride=2)
+        self.assertLess(len(requested), len(x))
+        self.assertEqual(adaptive_report(df, self.dense, 1, 1)["agreement"], 1.0)
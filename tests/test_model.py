@@ -21,11 +21,21 @@
 # -----------------------------------------------------#
 # External libraries
 import unittest
+import tempfile
 import os
+import sys
+import numpy as np
+import pandas as pd
+import pyvips
 from aucmedi import NeuralNetwork
 
 # Internal libraries
 from aucmedi.ensemble.aggregate import *
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from model import aggregate_predictions, load_model, run_aucmedi, cascade_report
+from proc import tile_grid, COL_NAMES
+from replicas import ReplicaPool
+from slide_reader import SlideReader
 
 # -----------------------------------------------------#
 #                Unittest: Model Access                #
@@ -51,4 +61,58 @@ class DeepGleasonModels(unittest.TestCase):
         path_model = os.path.join("models/model.ConvNeXtBase.hdf5")
         model = NeuralNetwork(n_labels=6, channels=3, architecture="2D.ConvNeXtBase")
         model.model.load_weights(path_model)
-        model.model.summary()
\ No newline at end of file
+        model.model.summary()
+
+    def test_ensemble_aggregate(self):
+        preds = np.asarray([[[0.6, 0.4], [0.2, 0.8]],
+                            [[0.3, 0.7], [0.1, 0.9]],
+                            [[0.9, 0.1], [0.4, 0.6]]], dtype=np.float32)
+        res = aggregate_predictions(preds, "mean")
+        self.assertTrue(np.allclose(res, [[0.6, 0.4], [0.7/3, 2.3/3]]))
+        res = aggregate_predictions(preds, "weighted", weights=[2, 1, 1])
+        self.assertTrue(np.allclose(res, [[0.6, 0.4], [0.225, 0.775]]))
+        res = aggregate_predictions(preds, "majority")
+        self.assertTrue(np.allclose(res, [[2/3, 1/3], [0.0, 1.0]]))
+
+    def test_cascade_report(self):
+        # Screening and main model share the architecture (e.g. different weights)
+        df_cascade = pd.DataFrame({"sample": ["a", "b", "c", "d"],
+                                   "class": ["N", "G3", "N", "N"],
+                                   "model": ["DenseNet121"] * 4,
+                                   "rescored": [False, True, False, False]})
+        df_full = pd.DataFrame({"sample": ["a", "b", "c", "d"],
+                                "class": ["N", "G3", "G4", "N"],
+                                "model": ["DenseNet121"] * 4})
+        report = cascade_report(df_cascade, df_full, 1.0, 2.0)
+        self.assertEqual(report["rescored"], 0.25)
+        self.assertEqual(report["agreement"], 0.75)
+        self.assertEqual(report["speedup"], 2.0)
+
+    def test_replicas(self):
+        # Slide with one page per RGB channel and 2x2 tiles
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        path_slide = os.path.join(tmp.name, "slide.tiff")
+        np.random.seed(1234)
+        array = np.random.randint(0, 255, size=(3 * 2048, 2048), dtype=np.uint8)
+        img = pyvips.Image.new_from_array(array).copy()
+        img.set_type(pyvips.GValue.gint_type, "page-height", 2048)
+        img.tiffsave(path_slide, tile=True, compression="deflate")
+        tiles = tile_grid(2048, 2048, "slide", (1024, 1024))
+        config = {"nclasses": len(COL_NAMES), "patch_size": (1024, 1024),
+                  "tiles": tiles, "slide_path": path_slide, "read_downsample": 1}
+        path_model = os.path.join("models/model.DenseNet121.hdf5")
+        settings = {"models": [path_model], "nclasses": len(COL_NAMES),
+                    "backend": "keras", "threads": None, "aggregate": "mean",
+                    "ensemble_weights": None, "cascade": None,
+                    "cascade_threshold": None, "cascade_criterion": None,
+                    "load_weights": True}
+        pool = ReplicaPool(settings, replicas=1, inter_op=1, chunk_size=2)
+        df = pool.predict(list(tiles["sample"]), config)
+        pool.close()
+        self.assertEqual(list(df["sample"]), list(tiles["sample"]))
+        # Replicas predict the same soft labels as the main process
+        config["slide_image"] = SlideReader(path_slide).image()
+        df_main = run_aucmedi(list(tiles["sample"]), load_model(path_model, len(COL_NAMES)),
+                              config)
+        self.assertTrue(np.allclose(df[COL_NAMES].to_numpy(),
+                                    df_main[COL_NAMES].to_numpy(), atol=1e-4))
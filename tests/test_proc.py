@@ -0,0 +1,158 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+import pyvips
+from proc import tile_grid, class_reassemble, COL_NAMES, PALETTE
+from proc import probability_reassemble, save_grid_maps
+from proc import otsu_threshold, tissue_mask
+
+#------------------------------------------------------#
+#              Unittest: Slide Processing              #
+#------------------------------------------------------#
+class DeepGleasonProcessing(unittest.TestCase):
+    # Create random predictions for a tile grid
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.patch_size = (1024, 1024)
+        self.max_X = 5 * 1024
+        self.max_Y = 3 * 1024
+        self.tiles = tile_grid(self.max_X, self.max_Y, "slide", self.patch_size)
+        probs = np.random.dirichlet(np.ones(len(COL_NAMES)), size=len(self.tiles))
+        self.df = pd.DataFrame(probs, columns=COL_NAMES)
+        self.df["sample"] = self.tiles["sample"]
+        self.df["class"] = self.df[COL_NAMES].idxmax(axis=1)
+
+    #--------------------------------------------------#
+    #                     Tile Grid                    #
+    #--------------------------------------------------#
+    def test_tile_grid(self):
+        self.assertEqual(len(self.tiles), 15)
+        row = self.tiles[(self.tiles["x"] == 4) & (self.tiles["y"] == 2)]
+        self.assertEqual(row["sample"].iloc[0], "slide_005120_003072")
+
+    #--------------------------------------------------#
+    #                  Tissue Detection                #
+    #--------------------------------------------------#
+    def test_otsu_threshold(self):
+        # Bimodal values (e.g. saturation of glass and stained tissue)
+        low = np.clip(np.random.normal(40, 5, size=1000), 0, 255).astype(np.uint8)
+        high = np.clip(np.random.normal(180, 5, size=3000), 0, 255).astype(np.uint8)
+        level = otsu_threshold(np.concatenate([low, high]))
+        # Values above the threshold are exactly the upper mode
+        self.assertTrue(low.max() <= level < high.min())
+
+    def test_tissue_mask(self):
+        # Glass slide with 5x3 tiles of 256x256 pixels and a known tissue layout
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        path_slide = os.path.join(tmp.name, "slide.tiff")
+        patch_size = (256, 256)
+        img = np.random.normal(loc=230, scale=3, size=(3 * 256, 5 * 256, 3))
+        stain = np.random.normal(loc=[170, 80, 150], scale=15,
+                                 size=(3 * 256, 5 * 256, 3))
+        tissue = np.zeros((3 * 256, 5 * 256), dtype=bool)
+        # Tiles fully covered by tissue (x, y)
+        for x, y in [(0, 0), (2, 1), (4, 2)]:
+            tissue[y*256:(y+1)*256, x*256:(x+1)*256] = True
+        # Tile with 10% tissue and tile with 2% tissue
+        tissue[2*256:2*256+52, 1*256:1*256+128] = True
+        tissue[0:36, 3*256:3*256+36] = True
+        img[tissue] = stain[tissue]
+        img = np.clip(img, 0, 255).astype(np.uint8)
+        pyvips.Image.new_from_array(img).tiffsave(path_slide, tile=True)
+        mask = tissue_mask(path_slide, 5 * 256, 3 * 256, patch_size)
+        self.assertEqual(mask.shape, (5, 3))
+        expected = np.zeros((5, 3), dtype=bool)
+        expected[0, 0] = expected[2, 1] = expected[4, 2] = expected[1, 2] = True
+        self.assertTrue(np.array_equal(mask, expected))
+        # Tile with 10% tissue is background for a higher tissue threshold
+        mask = tissue_mask(path_slide, 5 * 256, 3 * 256, patch_size, threshold=0.2)
+        expected[1, 2] = False
+        self.assertTrue(np.array_equal(mask, expected))
+
+    #--------------------------------------------------#
+    #                 Class Reassembly                 #
+    #--------------------------------------------------#
+    def test_class_reassemble_names(self):
+        res = class_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                               self.patch_size)
+        self.assertEqual(res.shape, (5, 3, 3))
+        self.assertEqual(res.dtype, np.uint8)
+        for sample, x, y in zip(self.tiles["sample"], self.tiles["x"],
+                                self.tiles["y"]):
+            label = self.df.loc[self.df["sample"] == sample, "class"].iloc[0]
+            self.assertTrue(np.array_equal(res[x, y],
+                                           PALETTE[COL_NAMES.index(label)]))
+
+    def test_class_reassemble_coordinates(self):
+        df = self.df.merge(self.tiles, on="sample")
+        res_coords = class_reassemble(self.max_X, self.max_Y, "slide", df,
+                                      self.patch_size)
+        res_names = class_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                                     self.patch_size)
+        self.assertTrue(np.array_equal(res_coords, res_names))
+
+    def test_class_reassemble_soft(self):
+        res = class_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                               self.patch_size, soft=True)
+        probs = self.df[COL_NAMES].to_numpy()
+        expected = probs @ PALETTE.astype(np.float64)
+        x, y = self.tiles["x"].iloc[0], self.tiles["y"].iloc[0]
+        self.assertTrue(np.allclose(res[x, y], expected[0], atol=1))
+
+    #--------------------------------------------------#
+    #                  Grid Resolution                 #
+    #--------------------------------------------------#
+    def test_probability_reassemble(self):
+        res = probability_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                                     self.patch_size)
+        self.assertEqual(res.shape, (5, 3, len(COL_NAMES)))
+        x, y = self.tiles["x"].iloc[7], self.tiles["y"].iloc[7]
+        self.assertTrue(np.allclose(res[x, y], self.df[COL_NAMES].iloc[7]))
+
+    def test_save_grid_maps(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        prefix = os.path.join(tmp.name, "slide_gleason")
+        small = class_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                                 self.patch_size)
+        probs = probability_reassemble(self.max_X, self.max_Y, "slide", self.df,
+                                       self.patch_size)
+        save_grid_maps(prefix, small, probs, 4.0, 4.0, self.patch_size,
+                       (self.max_X, self.max_Y))
+        grid = pyvips.Image.new_from_file(prefix + "_grid.tiff")
+        self.assertEqual((grid.width, grid.height), (5, 3))
+        self.assertTrue(np.array_equal(grid.numpy()[2, 4], small[4, 2]))
+        meta = json.loads(grid.get("image-description"))
+        self.assertEqual(meta["classes"], COL_NAMES)
+        self.assertEqual(meta["tile_size"], [1024, 1024])
+        page = pyvips.Image.new_from_file(prefix + "_probs.tiff", page=2)
+        self.assertEqual((page.width, page.height), (5, 3))
+        self.assertTrue(np.allclose(page.numpy()[2, 4] / 255, probs[4, 2, 2],
+                                    atol=1/255))
@@ -0,0 +1,89 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import shutil
+import time
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pyvips
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from proc import tile_grid, COL_NAMES
+from result_cache import ResultCache, slide_hash, result_key
+
+#------------------------------------------------------#
+#                Unittest: Result Cache                #
+#------------------------------------------------------#
+class DeepGleasonResultCache(unittest.TestCase):
+    # Create random predictions and a small slide
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        tiles = tile_grid(4 * 1024, 3 * 1024, "one", (1024, 1024))
+        probs = np.random.dirichlet(np.ones(len(COL_NAMES)), size=len(tiles))
+        df = pd.DataFrame(probs, columns=COL_NAMES)
+        df["sample"] = tiles["sample"]
+        df["class"] = df[COL_NAMES].idxmax(axis=1)
+        df["model"] = "DenseNet121"
+        self.preds = df.merge(tiles, on="sample")
+        self.tmp_data = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        self.slide = os.path.join(self.tmp_data.name, "slide.tiff")
+        img = pyvips.Image.black(512, 512, bands=3) + 128
+        img.cast("uchar").tiffsave(self.slide, tile=True)
+
+    def test_slide_hash(self):
+        # Same content under a different name results in the same hash
+        path_copy = os.path.join(self.tmp_data.name, "copy.tiff")
+        shutil.copyfile(self.slide, path_copy)
+        self.assertEqual(slide_hash(self.slide), slide_hash(path_copy))
+        self.assertNotEqual(result_key(slide_hash(self.slide), "a", {}),
+                            result_key(slide_hash(self.slide), "b", {}))
+
+    def test_put_get(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        cache = ResultCache(os.path.join(tmp.name, "cache"))
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", self.preds)
+        df = cache.get("key")
+        self.assertEqual(len(df), 12)
+        self.assertNotIn("sample", df.columns)
+        self.assertTrue(np.allclose(df[COL_NAMES].to_numpy(),
+                                    self.preds[COL_NAMES].to_numpy()))
+
+    def test_lru_eviction(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        cache = ResultCache(os.path.join(tmp.name, "cache"))
+        cache.put("first", self.preds)
+        size = os.path.getsize(cache.entry_path("first"))
+        cache.max_size = 2 * size
+        cache.put("second", self.preds)
+        time.sleep(0.01)
+        # Access of the first entry makes the second one least recently used
+        cache.get("first")
+        time.sleep(0.01)
+        cache.put("third", self.preds)
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertIsNotNone(cache.get("third"))
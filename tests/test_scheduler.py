@@ -0,0 +1,93 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import os
+import sys
+import time
+import multiprocessing
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from scheduler import WorkQueue
+
+def claim_all(path, slides):
+    # Worker process claiming and finishing slides
+    work_queue = WorkQueue(path)
+    claimed = []
+    for slide in work_queue.claim(slides):
+        time.sleep(0.01)
+        work_queue.release(slide, "done")
+        claimed.append(slide)
+    return claimed
+
+#------------------------------------------------------#
+#                 Unittest: Scheduler                  #
+#------------------------------------------------------#
+class DeepGleasonScheduler(unittest.TestCase):
+    # Create dummy slides of different sizes
+    @classmethod
+    def setUpClass(self):
+        self.tmp_data = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        self.slides = []
+        for i in range(20):
+            path = os.path.join(self.tmp_data.name, "slide%02d.tiff" % i)
+            with open(path, "wb") as f:
+                f.write(b"0" * (100 * ((i * 7) % 20 + 1)))
+            self.slides.append(path)
+
+    def test_claim_order(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        work_queue = WorkQueue(tmp.name)
+        claimed = list(work_queue.claim(self.slides))
+        sizes = [os.path.getsize(s) for s in claimed]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        # Held locks are not claimed by another worker
+        other = WorkQueue(tmp.name)
+        self.assertEqual(list(other.claim(self.slides)), [])
+        self.assertEqual(work_queue.status("slide00")["status"], "running")
+
+    def test_concurrent_workers(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        with multiprocessing.Pool(4) as pool:
+            res = pool.starmap(claim_all, [(tmp.name, self.slides)] * 4)
+        claimed = [s for r in res for s in r]
+        self.assertEqual(sorted(claimed), sorted(self.slides))
+        work_queue = WorkQueue(tmp.name)
+        self.assertTrue(all(work_queue.status(work_queue.name(s))["status"] == "done" \
+                            for s in self.slides))
+        self.assertEqual(os.listdir(os.path.join(tmp.name, "locks")), [])
+
+    def test_stale_lock(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        crashed = WorkQueue(tmp.name)
+        slide = next(crashed.claim(self.slides[:1]))
+        # Lock without heartbeat is recovered after the stale timeout
+        work_queue = WorkQueue(tmp.name, stale_timeout=60)
+        self.assertEqual(list(work_queue.claim(self.slides[:1])), [])
+        past = time.time() - 120
+        os.utime(crashed.lock_path(crashed.name(slide)), (past, past))
+        self.assertEqual(list(work_queue.claim(self.slides[:1])), [slide])
+        self.assertEqual(work_queue.status(work_queue.name(slide))["attempts"], 2)
+        # Failed slides are retried until the maximum number of attempts
+        work_queue.release(slide, "failed", error="test")
+        work_queue.max_attempts = 2
+        self.assertEqual(list(work_queue.claim(self.slides[:1])), [])
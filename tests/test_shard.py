@@ -0,0 +1,92 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pyvips
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from proc import tile_grid, select_tiles, COL_NAMES
+from store import PredictionStore
+
+#------------------------------------------------------#
+#                  Unittest: Sharding                  #
+#------------------------------------------------------#
+class DeepGleasonShard(unittest.TestCase):
+    # Create a small slide with one page per RGB channel
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.tmp_data = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        self.slide = os.path.join(self.tmp_data.name, "one.tiff")
+        width, height = 3 * 1024 + 100, 5 * 1024 + 100
+        img = pyvips.Image.black(width, 3 * height) + 200
+        img = img.cast("uchar").copy()
+        img.set_type(pyvips.GValue.gint_type, "page-height", height)
+        img.tiffsave(self.slide, tile=True)
+        self.tiles = tile_grid(3 * 1024, 5 * 1024, "one", (1024, 1024))
+
+    def predict(self, tiles):
+        probs = np.random.dirichlet(np.ones(len(COL_NAMES)), size=len(tiles))
+        df = pd.DataFrame(probs, columns=COL_NAMES)
+        df["sample"] = tiles["sample"].to_numpy()
+        df["x"] = tiles["x"].to_numpy()
+        df["y"] = tiles["y"].to_numpy()
+        df["class"] = df[COL_NAMES].idxmax(axis=1)
+        df["model"] = "DenseNet121"
+        return df
+
+    def test_select_tiles(self):
+        # Row bands are disjoint and cover the whole grid
+        shards = [select_tiles(self.tiles, shard=(i, 3)) for i in range(3)]
+        self.assertEqual(sum(len(s) for s in shards), len(self.tiles))
+        self.assertEqual(len(set.union(*[set(s["sample"]) for s in shards])),
+                         len(self.tiles))
+        self.assertEqual(sorted(shards[0]["y"].unique()), [0, 1])
+        shard = select_tiles(self.tiles, tile_range=(4, 9))
+        self.assertEqual(list(shard["sample"]), list(self.tiles["sample"][4:9]))
+
+    def test_merge(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        store = PredictionStore(os.path.join(tmp.name, "predictions.store"))
+        # Partial predictions of two shards
+        for i in range(2):
+            shard = select_tiles(self.tiles, shard=(i, 3))
+            store.append(store.partial_name("one", "%d-of-3" % i), self.predict(shard))
+        self.assertEqual(store.slides(), [])
+        path_preds = os.path.join(tmp.name, "preds.csv")
+        cmd = "python code/merge.py -i " + self.slide + " -o " + tmp.name + \
+              " -p " + path_preds
+        # Incomplete shards are not merged
+        self.assertEqual(os.system(cmd), 0)
+        self.assertFalse(store.contains("one"))
+        shard = select_tiles(self.tiles, shard=(2, 3))
+        store.append(store.partial_name("one", "2-of-3"), self.predict(shard))
+        self.assertEqual(os.system(cmd), 0)
+        self.assertTrue(store.contains("one"))
+        self.assertEqual(store.partials("one"), [])
+        self.assertEqual(len(pd.read_csv(path_preds)), len(self.tiles))
+        res = pyvips.Image.new_from_file(os.path.join(tmp.name, "one_gleason.tiff"))
+        self.assertEqual((res.width, res.height), (3 * 1024, 5 * 1024))
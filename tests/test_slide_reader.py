@@ -0,0 +1,97 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import os
+import sys
+import numpy as np
+import pyvips
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from slide_reader import SlideReader
+from proc import gen_tiles
+
+#------------------------------------------------------#
+#                 Unittest: Slide Reader               #
+#------------------------------------------------------#
+class DeepGleasonSlideReader(unittest.TestCase):
+    # Store the same random slide in different layouts (lossless)
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.tmp_data = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        self.array = np.random.randint(0, 255, size=(1024, 2048, 3), dtype=np.uint8)
+        rgb = pyvips.Image.new_from_array(self.array, interpretation="srgb")
+        props = {"tile": True, "tile_width": 256, "tile_height": 256,
+                 "compression": "deflate", "xres": 4000, "yres": 4000}
+        self.paths = {}
+        # One page per RGB channel with sub-IFD pyramid (DeepGleason layout)
+        channels = pyvips.Image.arrayjoin([rgb[0], rgb[1], rgb[2]], across=1).copy()
+        channels.set_type(pyvips.GValue.gint_type, "page-height", rgb.height)
+        self.paths["channels"] = os.path.join(self.tmp_data.name, "channels.tiff")
+        channels.tiffsave(self.paths["channels"], pyramid=True, subifd=True, **props)
+        # Interleaved RGB with sub-IFD pyramid
+        self.paths["interleaved"] = os.path.join(self.tmp_data.name, "interleaved.tiff")
+        rgb.tiffsave(self.paths["interleaved"], pyramid=True, subifd=True, **props)
+        # Interleaved RGB with pyramid levels as pages and OME description
+        ome = rgb.copy()
+        ome.set_type(pyvips.GValue.gstr_type, "image-description",
+                     '<?xml version="1.0"?><OME xmlns="http://www.openmicroscopy.org/' + \
+                     'Schemas/OME/2016-06"></OME>')
+        self.paths["ome"] = os.path.join(self.tmp_data.name, "slide.ome.tiff")
+        ome.tiffsave(self.paths["ome"], pyramid=True, **props)
+
+    def test_layout(self):
+        self.assertEqual(SlideReader(self.paths["channels"]).layout, "channels")
+        self.assertEqual(SlideReader(self.paths["interleaved"]).layout, "interleaved")
+        reader = SlideReader(self.paths["ome"])
+        self.assertEqual((reader.format, reader.layout), ("ome-tiff", "interleaved"))
+        self.assertEqual(SlideReader(self.paths["interleaved"]).format, "tiff")
+
+    def test_image(self):
+        for name, path in self.paths.items():
+            reader = SlideReader(path)
+            self.assertEqual((reader.width, reader.height), (2048, 1024))
+            img = reader.image()
+            self.assertEqual(img.bands, 3)
+            self.assertTrue(np.array_equal(img.numpy(), self.array), name)
+            # Sequential reads share the opened random access handle
+            self.assertIs(reader.image(access="sequential"), img)
+
+    def test_level(self):
+        for name, path in self.paths.items():
+            reader = SlideReader(path)
+            self.assertIn(4, [f for f, _ in reader.levels()], name)
+            img, factor = reader.level(5)
+            self.assertEqual(factor, 4)
+            self.assertEqual((img.width, img.height, img.bands), (512, 256, 3))
+            thumb = reader.thumbnail(32, 16)
+            self.assertEqual((thumb.width, thumb.height, thumb.bands), (32, 16, 3))
+
+    def test_gen_tiles(self):
+        reader = SlideReader(self.paths["channels"])
+        img, tiles, width, height, xres, yres, read_size = gen_tiles(
+            None, reader, "channels", (512, 512), 0.05, downsample=2)
+        self.assertEqual(len(tiles), 8)
+        self.assertEqual(read_size, (256, 256))
+        self.assertEqual((width, height), (2048, 1024))
+        self.assertEqual((img.width, img.height), (1024, 512))
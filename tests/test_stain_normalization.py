@@ -0,0 +1,102 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import os
+import sys
+import numpy as np
+from PIL import Image
+from histolab.stain_normalizer import ReinhardStainNormalizer
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from stain_normalization import StainNormalization, tissue_masks
+
+#------------------------------------------------------#
+#            Unittest: Stain Normalization             #
+#------------------------------------------------------#
+class DeepGleasonStainNormalization(unittest.TestCase):
+    # Create synthetic H&E-like tiles and load stain normalization target
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.target = Image.open(os.path.join("code", "stainnormalize_target.png"))
+        self.images = []
+        for i in range(4):
+            # glass background
+            img = np.random.normal(loc=235, scale=5, size=(128, 128, 3))
+            # stained tissue region
+            stain = np.random.randint(60, 200, size=3)
+            tissue = np.random.normal(loc=stain, scale=20, size=(64, 96, 3))
+            x, y = np.random.randint(0, 32, size=2)
+            img[x:x+64, y:y+96] = tissue
+            self.images.append(np.clip(img, 0, 255).astype(np.uint8))
+        self.images = np.stack(self.images, axis=0)
+        # Crops of real tissue from the stain normalization target
+        target = np.asarray(self.target.convert("RGB"))
+        self.crops = np.stack([target[y:y+224, x:x+224] for y, x in \
+                               [(0, 0), (200, 300), (400, 600), (100, 500), (411, 0)]])
+        # Gland: ring of stained epithelium around a bright lumen
+        xx, yy = np.mgrid[0:128, 0:128]
+        radius = np.hypot(xx - 64, yy - 64)
+        ring = (radius >= 20) & (radius < 40)
+        gland = np.random.normal(loc=235, scale=5, size=(128, 128, 3))
+        gland[ring] = np.random.normal(loc=[150, 60, 130], scale=20,
+                                       size=(ring.sum(), 3))
+        self.gland = np.clip(gland, 0, 255).astype(np.uint8)[None]
+
+    #--------------------------------------------------#
+    #                Parity with histolab              #
+    #--------------------------------------------------#
+    def assert_parity(self, images):
+        sf = StainNormalization(self.target)
+        histolab_normalizer = ReinhardStainNormalizer()
+        histolab_normalizer.fit(self.target.convert("RGB"))
+        preds = sf.transform_batch(images)
+        for i in range(len(images)):
+            img_pil = Image.fromarray(images[i]).convert("RGB")
+            ref = np.asarray(histolab_normalizer.transform(img_pil))
+            diff = np.abs(preds[i].astype(np.float32) - ref)
+            self.assertTrue(np.mean(diff) <= 0.5)
+            self.assertTrue(np.percentile(diff, 95) <= 1.0)
+
+    def test_parity_histolab(self):
+        self.assert_parity(self.images)
+
+    def test_parity_histolab_tissue(self):
+        self.assert_parity(self.crops)
+
+    def test_parity_histolab_gland(self):
+        self.assert_parity(self.gland)
+        # Lumen is filled as tissue
+        mask = tissue_masks(self.gland)
+        self.assertTrue(mask[0, 64, 64])
+
+    #--------------------------------------------------#
+    #               Batch vs Single Image              #
+    #--------------------------------------------------#
+    def test_batch_single_identical(self):
+        sf = StainNormalization(self.target)
+        preds_batch = sf.transform_batch(self.images)
+        for i in range(len(self.images)):
+            pred = sf.transform(self.images[i])
+            self.assertEqual(pred.shape, self.images[i].shape)
+            self.assertEqual(pred.dtype, np.uint8)
+            self.assertTrue(np.array_equal(pred, preds_batch[i]))
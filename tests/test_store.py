@@ -0,0 +1,122 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from proc import tile_grid, COL_NAMES
+from store import PredictionStore
+
+#------------------------------------------------------#
+#               Unittest: Prediction Store             #
+#------------------------------------------------------#
+class DeepGleasonStore(unittest.TestCase):
+    # Create random predictions for two slides
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.preds = {}
+        for name in ["one", "two"]:
+            tiles = tile_grid(4 * 1024, 3 * 1024, name, (1024, 1024))
+            probs = np.random.dirichlet(np.ones(len(COL_NAMES)), size=len(tiles))
+            df = pd.DataFrame(probs, columns=COL_NAMES)
+            df["sample"] = tiles["sample"]
+            df["class"] = df[COL_NAMES].idxmax(axis=1)
+            df["model"] = "DenseNet121"
+            self.preds[name] = df.merge(tiles, on="sample")
+
+    def test_append_load(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        store = PredictionStore(os.path.join(tmp.name, "store"))
+        for name, df in self.preds.items():
+            store.append(name, df)
+        self.assertEqual(store.slides(), ["one", "two"])
+        self.assertTrue(store.contains("one"))
+        # Load single slide
+        df = store.load("two")
+        self.assertEqual(len(df), 12)
+        self.assertEqual(df["x"].dtype, np.int32)
+        self.assertEqual(df[COL_NAMES[0]].dtype, np.float32)
+        self.assertTrue(np.allclose(df[COL_NAMES].to_numpy(),
+                                    self.preds["two"][COL_NAMES].to_numpy()))
+        # Load all slides
+        df = store.load()
+        self.assertEqual(len(df), 24)
+        self.assertEqual(set(df["slide"]), {"one", "two"})
+
+    def test_export_csv(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        store = PredictionStore(os.path.join(tmp.name, "store"))
+        for name, df in self.preds.items():
+            store.append(name, df)
+        path_csv = os.path.join(tmp.name, "preds.csv")
+        store.export_csv(path_csv)
+        df = pd.read_csv(path_csv)
+        self.assertEqual(len(df), 24)
+        self.assertFalse(any(c.startswith("Unnamed") for c in df.columns))
+
+    def test_ensemble_columns(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        store = PredictionStore(os.path.join(tmp.name, "store"))
+        df = self.preds["one"].copy()
+        for c in COL_NAMES:
+            df[c + ".DenseNet121"] = df[c]
+        store.append("one", df)
+        df = store.load("one")
+        self.assertIn("G3.DenseNet121", df.columns)
+        self.assertEqual(df["G3.DenseNet121"].dtype, np.float32)
+        # Soft labels of ensemble members are kept for resuming
+        store.append_progress("one", self.preds["one"].assign(**{"G3.ConvNeXtBase": 0.5}))
+        self.assertIn("G3.ConvNeXtBase", store.load_progress("one").columns)
+
+    def test_resume(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        store = PredictionStore(os.path.join(tmp.name, "store"))
+        df = self.preds["one"]
+        samples = list(df["sample"])
+        # Overlapping chunks (e.g. a chunk rewritten after a restart)
+        store.append_progress("one", df.iloc[:4])
+        store.append_progress("one", df.iloc[2:6].assign(model="ConvNeXtBase"))
+        # Last line truncated by an interruption during writing
+        with open(store.progress_path("one"), "a") as f:
+            f.write(samples[6] + ",0.12")
+        df_done, x = store.resume("one", samples)
+        self.assertEqual(list(df_done["sample"]), samples[:6])
+        self.assertEqual(list(df_done["model"]), ["DenseNet121"] * 2 + \
+                                                 ["ConvNeXtBase"] * 4)
+        self.assertTrue(np.allclose(df_done[COL_NAMES].to_numpy(),
+                                    df[COL_NAMES].iloc[:6].to_numpy()))
+        # Only unscored tiles are predicted
+        self.assertEqual(x, samples[6:])
+        # Appending after the truncated line keeps the progress file readable
+        store.append_progress("one", df.iloc[6:8])
+        df_done, x = store.resume("one", samples)
+        self.assertEqual(list(df_done["sample"]), samples[:8])
+        self.assertEqual(x, samples[8:])
+        store.clear_progress("one")
+        df_done, x = store.resume("one", samples)
+        self.assertEqual(len(df_done), 0)
+        self.assertEqual(x, samples)
@@ -0,0 +1,86 @@
+# ==============================================================================#
+#  Author:       Dominik Müller                                                #
+#  Copyright:    2023 IT-Infrastructure for Translational Medical Research,    #
+#                University of Augsburg                                        #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#------------------------------------------------------#
+#                    Library imports                   #
+#------------------------------------------------------#
+# External libraries
+import unittest
+import tempfile
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Internal libraries
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+from tile_cache import TileCache, cache_loader
+
+#------------------------------------------------------#
+#                 Unittest: Tile Cache                 #
+#------------------------------------------------------#
+class DeepGleasonTileCache(unittest.TestCase):
+    # Create random preprocessed tiles
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(1234)
+        self.tiles = pd.DataFrame({"sample": ["slide_%06d_%06d" % (i, i) \
+                                              for i in range(10)],
+                                   "x": np.arange(10), "y": np.arange(10)})
+        self.imgs = np.random.randint(0, 256, size=(10, 32, 48, 3), dtype=np.uint8)
+
+    def test_write_open(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        cache = TileCache(os.path.join(tmp.name, "tiles"))
+        self.assertFalse(cache.contains("slide", (48, 32)))
+        chunks = [self.imgs[i:i+4] for i in range(0, 10, 4)]
+        cache.write("slide", (48, 32), self.tiles, chunks)
+        self.assertTrue(cache.contains("slide", (48, 32)))
+        self.assertTrue(cache.contains("slide", (48, 32), self.tiles["sample"][:3]))
+        self.assertFalse(cache.contains("slide", (48, 32), ["other"]))
+        self.assertFalse(cache.contains("slide", (32, 32)))
+        # Tiles are memory-mapped
+        tiles, index = cache.open("slide", (48, 32))
+        self.assertIsInstance(tiles, np.memmap)
+        self.assertTrue(np.array_equal(tiles, self.imgs))
+        self.assertEqual(list(index["sample"]), list(self.tiles["sample"]))
+        # Load tiles via AUCMEDI loader
+        cache_index = dict(zip(index["sample"], range(len(index))))
+        img = cache_loader(self.tiles["sample"][7], None, cache_tiles=tiles,
+                           cache_index=cache_index)
+        self.assertTrue(np.array_equal(img, self.imgs[7]))
+        del tiles
+        cache.remove("slide", (48, 32))
+        self.assertFalse(cache.contains("slide", (48, 32)))
+
+    def test_settings(self):
+        tmp = tempfile.TemporaryDirectory(prefix="tmp.DeepGleason.")
+        cache = TileCache(os.path.join(tmp.name, "tiles"))
+        settings = {"slide_hash": "abc", "patch_size": (48, 32),
+                    "read_downsample": 1, "stain_full_resolution": False}
+        cache.write("slide", (48, 32), self.tiles, [self.imgs], settings)
+        self.assertTrue(cache.contains("slide", (48, 32), settings=settings))
+        self.assertTrue(cache.contains("slide", (48, 32), self.tiles["sample"],
+                                       settings=dict(settings)))
+        # Entries of changed slides or preprocessing are not reused
+        for key, value in [("slide_hash", "def"), ("read_downsample", 2),
+                           ("stain_full_resolution", True)]:
+            self.assertFalse(cache.contains("slide", (48, 32),
+                                            settings=dict(settings, **{key: value})))
+        # Entries without settings are not reused if settings are requested
+        cache.write("slide", (48, 32), self.tiles, [self.imgs])
+        self.assertFalse(cache.contains("slide", (48, 32), settings=settings))
+        self.assertTrue(cache.contains("slide", (48, 32)))
@@ -72,6 +72,21 @@ class DeepGleasonUsage(unittest.TestCase):
         res = os.system("python code/main.py --help")
         self.assertEqual(res, 0)
 
+    #--------------------------------------------------#
+    #          Run DeepGleason - Missing Input         #
+    #--------------------------------------------------#
+    def test_runDeepGleason_missing_input(self):
+        path_output = os.path.join(self.tmp_data.name, "missing")
+        path_slide = os.path.join(self.tmp_data.name, "missing.tiff")
+        res = os.system("python code/main.py -i " + path_slide + " -o " + path_output)
+        self.assertNotEqual(res, 0)
+        # Manifest listing a missing slide
+        path_manifest = os.path.join(self.tmp_data.name, "manifest.txt")
+        with open(path_manifest, "w") as writer:
+            writer.write(path_slide + "\n")
+        res = os.system("python code/main.py -i " + path_manifest + " -o " + path_output)
+        self.assertNotEqual(res, 0)
+
     #--------------------------------------------------#
     #              Run DeepGleason - Basic             #
     #--------------------------------------------------#